@@ -1,14 +1,18 @@
 import os
-from fastapi import APIRouter, Depends, File, UploadFile
-from sqlalchemy.orm import Session
+from datetime import datetime
+import io
+from fastapi import APIRouter, Depends, File, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from router.auth import get_current_user
-from schemas import AdvertisementBase, AdvertisementDisplay, AdvertisementEditBase, AdvertisementOneDisplay, AdvertisementStatusDisplay,AdvertisementShortDisplay, AdvertisementWithRating
-from db import db_advertisement
-from typing import List, Optional
-from db.database import get_db
-from typing import List
-from sqlalchemy.orm.session import Session
+from schemas import ExportSinceFieldEnum, ImportFormatEnum, AdvertisementImportReport, AdvertisementBase, AdvertisementDisplay, AdvertisementSortEnum, AdvertisementEditBase, AdvertisementOneDisplay, AdvertisementStatusDisplay,AdvertisementShortDisplay, AdvertisementPage
+from db import db_advertisement, db_export, db_import
+from typing import Optional
+from db.database import get_async_db
+from sqlalchemy.ext.asyncio import AsyncSession
 from utils.security import oauth2_scheme
+from utils import fast_json
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 router = APIRouter(
     prefix='/advertisements',
@@ -23,45 +27,74 @@ router = APIRouter(
 @router.get(
     "/search",
     summary="Search Ads by Keyword + Category",
-    description="This API call enables users to search by keyword and filter by category. Results are sorted by recency and seller rating.",
-    response_model=List[AdvertisementWithRating],
+    description="This API call enables users to search by keyword and filter by category. Keywords match whole words and word prefixes. Results are sorted by recency, or by relevance to the keyword with sort=relevance. Pass next_cursor back as cursor to get the next page.",
+    response_model=AdvertisementPage,
 )
-def get_filtered_advertisements(
+async def get_filtered_advertisements(
     search: Optional[str] = None,
     category_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    sort: AdvertisementSortEnum = AdvertisementSortEnum.RECENT,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    return db_advertisement.get_filtered_advertisements(db, search, category_id)
+    page = await db.run_sync(
+        lambda session: db_advertisement.get_filtered_advertisements(session, search, category_id, sort, cursor, limit, fast_json.FAST_JSON_LISTINGS)
+    )
+    return fast_json.FastJSONResponse(page) if fast_json.FAST_JSON_LISTINGS else page
 
 
 
 #creating one advertisement
 @router.post('/create',response_model=AdvertisementDisplay)
-def create_advertisement(request:AdvertisementBase,db:Session=Depends(get_db), user_id: int = Depends(get_current_user)):
-    return  db_advertisement.create_advertisement(db,request,user_id)
+async def create_advertisement(request:AdvertisementBase,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    # serialized inside run_sync, where user and category can still be lazy loaded
+    return await db.run_sync(lambda session: AdvertisementDisplay.model_validate(db_advertisement.create_advertisement(session,request,user_id)))
 
-#selecting all advertisements
-@router.get('/all',response_model=List[AdvertisementWithRating])
-def get_all_advertisements(db:Session=Depends(get_db)):
-    return db_advertisement.get_all_advertisements(db)
+#bulk import: a CSV (with a header line) or NDJSON body of AdvertisementImportRow records, owned by the
+#current user; rows go in by batches and the report lists the rows that were skipped and why
+@router.post('/import',response_model=AdvertisementImportReport)
+async def import_advertisements(request:Request,format:Optional[ImportFormatEnum]=None,user_id:int=Depends(get_current_user)):
+    if format is None:
+        format = ImportFormatEnum.CSV if "csv" in request.headers.get("content-type", "") else ImportFormatEnum.NDJSON
+    with await db_import.spool_import(request.stream()) as spool:
+        lines = io.TextIOWrapper(spool, encoding="utf-8-sig", errors="surrogateescape", newline="")
+        return await run_in_threadpool(db_import.import_advertisements, lines, format.value, user_id)
+
+#selecting all advertisements, one page at a time
+@router.get('/all',response_model=AdvertisementPage)
+async def get_all_advertisements(cursor:Optional[str]=None,limit:int=Query(DEFAULT_PAGE_SIZE,ge=1,le=MAX_PAGE_SIZE),db:AsyncSession=Depends(get_async_db)):
+    page = await db.run_sync(lambda session: db_advertisement.get_all_advertisements(session,cursor,limit,fast_json.FAST_JSON_LISTINGS))
+    return fast_json.FastJSONResponse(page) if fast_json.FAST_JSON_LISTINGS else page
+
+#the whole catalogue as NDJSON (optionally gzipped), streamed batch by batch; since= limits it to ads
+#created or updated from EXPORT_SINCE_OVERLAP seconds before that time on, so rows can repeat between
+#exports and are meant to be upserted by id. Declared before /{id}, which would otherwise match it.
+@router.get('/export',response_class=StreamingResponse)
+async def export_advertisements(since:Optional[datetime]=None,since_field:ExportSinceFieldEnum=ExportSinceFieldEnum.UPDATED_AT,gzip:bool=False,user_id:int=Depends(get_current_user)):
+    chunks = db_export.export_advertisements(since, since_field.value)
+    if gzip:
+        return StreamingResponse(db_export.gzip_stream(chunks), media_type="application/gzip",
+                                 headers={"Content-Disposition": 'attachment; filename="advertisements.ndjson.gz"'})
+    return StreamingResponse(chunks, media_type="application/x-ndjson")
 
 #selecting one advertisement
 @router.get('/{id}',response_model=AdvertisementOneDisplay)
-def get_one_advertisement(id:int,db:Session=Depends(get_db)):
-    return db_advertisement.get_one_advertisement(id,db)
+async def get_one_advertisement(id:int,db:AsyncSession=Depends(get_async_db)):
+    return await db.run_sync(lambda session: db_advertisement.get_one_advertisement(id,session))
 
 #editing  one advertisement
 @router.patch('/{id}/edit',response_model=AdvertisementDisplay)
-def edit_advertisement(id:int,request:AdvertisementEditBase,db:Session=Depends(get_db), user_id: int = Depends(get_current_user)):
-    return db_advertisement.edit_advertisement(id,request,db,user_id)
+async def edit_advertisement(id:int,request:AdvertisementEditBase,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    return await db.run_sync(lambda session: AdvertisementDisplay.model_validate(db_advertisement.edit_advertisement(id,request,session,user_id)))
 
 #deleting one advertisement
 @router.delete('/{id}')
-def delete_advertisement(id:int,db:Session=Depends(get_db), user_id: int = Depends(get_current_user)):
-    return db_advertisement.delete_advertisement(id,db,user_id)
+async def delete_advertisement(id:int,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    return await db.run_sync(lambda session: db_advertisement.delete_advertisement(id,session,user_id))
 
 #updating status of one advertisement
 @router.patch('/{id}/status',response_model=AdvertisementStatusDisplay)
-def status_advertisement(id:int,request:AdvertisementStatusDisplay,db:Session=Depends(get_db), user_id: int = Depends(get_current_user)):
-    return db_advertisement.status_advertisement(id,request,db,user_id)
+async def status_advertisement(id:int,request:AdvertisementStatusDisplay,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    return await db.run_sync(lambda session: db_advertisement.status_advertisement(id,request,session,user_id))
 
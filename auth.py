@@ -1,17 +1,31 @@
 
+import os
 import re
+import time
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import attributes
 from db.model import DbUser
 from schemas import UserCreate, UserOut
-from db.database import get_db
-from utils.security import hash_password,verify_password,create_access_token,ALGORITHM,SECRET_KEY,oauth2_scheme
+from db.database import SessionLocal, get_async_db
+from utils.cache import TTLCache
+from utils.revocation import RevocationStoreFull, get_revocation_store, token_id
+from utils.security import hash_password_async,verify_and_update_password,create_access_token,ALGORITHM,SECRET_KEY,oauth2_scheme
 
 router = APIRouter()
 
-blacklisted_tokens = set()
+# verified token -> claims, and token subject -> UserOut, so authenticated requests need neither a
+# signature check nor a user lookup each time; invalidate_user drops a user whose row changed
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+_decoded_tokens = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+_principals = TTLCache(TOKEN_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
 
 def validate_password(password: str):
     if len(password) < 8 or len(password) > 20:
@@ -26,66 +40,140 @@ def validate_email(email: str):
     if not re.fullmatch(pattern, email):
         raise HTTPException(status_code=400, detail="Invalid email format")
 
+# password hashing runs on the dedicated bcrypt pool, with no database connection held meanwhile
 @router.post("/register", response_model=UserOut)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     validate_email(user.email)
     validate_password(user.password)
-    existing_user = db.query(DbUser).filter(DbUser.email == user.email).first()
+    existing_user = (await db.execute(select(DbUser.id).where(DbUser.email == user.email))).first()
+    await db.rollback()
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_pw = hash_password(user.password)
+    hashed_pw = await hash_password_async(user.password)
     db_user = DbUser(email=user.email, hashed_password=hashed_pw, username=user.username)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 @router.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(DbUser).filter(DbUser.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(
+        select(DbUser.id, DbUser.email, DbUser.hashed_password).where(DbUser.email == form_data.username)
+    )).first()
+    await db.rollback()
+    valid, new_hash = await verify_and_update_password(form_data.password, user.hashed_password) if user else (False, None)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect email or password")
-    access_token = create_access_token(data={"sub": user.email})
+    if new_hash:  # BCRYPT_ROUNDS changed since this password was hashed
+        await db.execute(update(DbUser).where(DbUser.id == user.id).values(hashed_password=new_hash))
+        await db.commit()
+    access_token = create_access_token(data={"sub": str(user.id)})
     return {"access_token": access_token, "token_type": "bearer"}
 
+# the token stays revoked until it would have expired anyway; when the store cannot take another
+# revocation the logout fails with 503 and the client can retry, instead of an older logout being undone
 @router.post("/logout")
-def logout(token: str = Depends(oauth2_scheme)):
-    blacklisted_tokens.add(token)
+async def logout(token: str = Depends(oauth2_scheme)):
+    try:
+        payload = _decode_token(token)
+    except JWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    try:
+        await get_revocation_store().revoke(token_id(token, payload), payload["exp"])
+    except RevocationStoreFull:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many logouts to remember, try again later", headers={"Retry-After": "60"})
     return {"msg": "Successfully logged out"}
 
-@router.get("/me", response_model=UserOut)
-def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    if token in blacklisted_tokens:
+# claims of a valid token; raises JWTError otherwise. Cached entries never outlive the token's exp.
+def _decode_token(token: str) -> dict:
+    payload = _decoded_tokens.get(token)
+    if payload is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        ttl = TOKEN_CACHE_TTL
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        _decoded_tokens.set(token, payload, ttl)
+    return payload
+
+
+def _load_principal(subject: str) -> Optional[UserOut]:
+    db = SessionLocal()
+    try:
+        query = db.query(DbUser.id, DbUser.username, DbUser.email)
+        if subject.isdigit():
+            user = query.filter(DbUser.id == int(subject)).first()
+        else:  # tokens issued before sub carried the user id name the user by email
+            user = query.filter(DbUser.email == subject).first()
+        return UserOut.model_validate(user) if user else None
+    finally:
+        db.close()
+
+
+async def _check_not_revoked(token: str, payload: dict):
+    if await get_revocation_store().is_revoked(token_id(token, payload)):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+
+# the user a token subject names, or None if there is no such user; a cache miss is one query on the threadpool
+async def _get_principal(subject: str) -> Optional[UserOut]:
+    principal = _principals.get(subject)
+    if principal is None:
+        principal = await run_in_threadpool(_load_principal, subject)
+        if principal is not None:
+            _principals.set(subject, principal)
+    return principal
+
+
+# call when a user is changed or deleted, so their tokens stop resolving to the cached principal
+def invalidate_user(user_id: int, email: Optional[str] = None):
+    _principals.pop(str(user_id))
+    if email:
+        _principals.pop(email)
+
+
+@event.listens_for(DbUser, "after_update")
+@event.listens_for(DbUser, "after_delete")
+def _invalidate_changed_user(mapper, connection, target: DbUser):
+    invalidate_user(target.id, target.email)
+    for old_email in attributes.get_history(target, "email").deleted:
+        _principals.pop(old_email)
+
+
+@router.get("/me", response_model=UserOut)
+async def read_users_me(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-        user = db.query(DbUser).filter(DbUser.email == email).first()
-        if not user:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-        return user
+        payload = _decode_token(token)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    await _check_not_revoked(token, payload)
+    subject = payload.get("sub")
+    if not subject:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    user = await _get_principal(subject)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+    return user
 
 
 
 
-#getting user_id from token
+#getting user_id from token; no database access while the token and its user are cached (revocations are checked every time)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme),db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> int:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token payload invalid")
+        payload = _decode_token(token)
+    except JWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+    await _check_not_revoked(token, payload)
+    subject = payload.get("sub")
+    if subject is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token payload invalid")
 
-        user = db.query(DbUser).filter(DbUser.email == email).first()
-        if user is None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    user = await _get_principal(subject)
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-        return user.id  # return actual user ID
-    except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
\ No newline at end of file
+    return user.id  # return actual user ID
@@ -0,0 +1,130 @@
+# Throughput of /advertisements/all on the async session vs the old sync route.
+#
+#   python bench_async_db.py --seed 2000 --requests 2000 --concurrency 10 100 500
+#
+# Both apps are driven in-process through httpx's ASGI transport, so the numbers
+# compare the request paths, not uvicorn or the network. Neither has the response cache in
+# front of it, and both run against a throwaway SQLite file rather than DATABASE_URL.
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# the engines are created when db.database is imported, so the throwaway database is set up first
+_directory = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory, 'bench.db')}"
+os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(_directory, 'bench.db')}"
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy.orm import Session
+
+from db import db_advertisement, migrations
+from db.database import SessionLocal, async_engine, engine, get_db
+from db.model import DbAdvertisement, DbCategory, DbUser
+from router import advertisement
+from schemas import AdvertisementPage
+
+# the async route as main.app serves it, minus ResponseCacheMiddleware, which would answer
+# every request after the first from memory
+async_app = FastAPI()
+async_app.include_router(advertisement.router)
+
+# the pre-async route: a plain def on Starlette's threadpool with a blocking Session
+sync_app = FastAPI()
+
+
+@sync_app.get("/advertisements/all", response_model=AdvertisementPage)
+def get_all_advertisements_sync(db: Session = Depends(get_db)):
+    return db_advertisement.get_all_advertisements(db)
+
+
+def seed(count: int):
+    db = SessionLocal()
+    try:
+        user = DbUser(username="bench", email=f"bench_{time.time_ns()}@example.com", hashed_password="x")
+        category = DbCategory(title="bench")
+        db.add_all([user, category])
+        db.flush()
+        now = datetime.utcnow()
+        db.add_all(
+            DbAdvertisement(
+                title=f"bench ad {i}",
+                content="benchmark content",
+                price=10,
+                created_at=now - timedelta(seconds=i),
+                user_id=user.id,
+                category_id=category.id,
+            )
+            for i in range(count)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run(target, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=target), base_url="http://bench") as client:
+
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.get("/advertisements/all")
+                    response.raise_for_status()
+                except Exception:
+                    # e.g. the sync path exhausting its connection pool while the
+                    # threadpool is full of requests waiting for a connection
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0, help="insert this many ads first")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 500])
+    args = parser.parse_args()
+
+    migrations.upgrade(engine)
+    if args.seed:
+        seed(args.seed)
+
+    print(f"{'concurrency':>11} {'path':>5} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for concurrency in args.concurrency:
+        for name, target in (("sync", sync_app), ("async", async_app)):
+            result = await run(target, args.requests, concurrency)
+            print(
+                f"{concurrency:>11} {name:>5} {result['rps']:>9.1f} {result['p50_ms']:>9.1f}"
+                f" {result['p99_ms']:>9.1f} {result['errors']:>7}"
+            )
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        shutil.rmtree(_directory, ignore_errors=True)
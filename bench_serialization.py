@@ -0,0 +1,101 @@
+# Building and encoding a listing page: ORM objects + AdvertisementPage validation + json.dumps (the
+# default path) vs column tuples + fast_json (FAST_JSON_LISTINGS=on).
+#
+#   python bench_serialization.py --rows 100 1000 10000 --repeat 5
+#
+# Runs against a throwaway SQLite file seeded with the largest row count, and calls the db functions
+# directly because the routes cap pages at MAX_PAGE_SIZE. Times are the best of --repeat runs.
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import sessionmaker
+
+from db import db_advertisement, migrations
+from db.database import create_db_engine
+from db.model import DbAdvertisement, DbCategory, DbUser
+from schemas import AdvertisementPage
+from utils import fast_json
+
+
+def seed(Session, count: int):
+    db = Session()
+    try:
+        user = DbUser(username="bench", email="bench@example.com", hashed_password="x", address="Main St 1", phone="555")
+        category = DbCategory(title="bench", advertisement_count=count, open_advertisement_count=count)
+        db.add_all([user, category])
+        db.flush()
+        now = datetime.utcnow()
+        db.add_all(
+            DbAdvertisement(
+                title=f"bench ad {i}",
+                content="benchmark content " * 10,
+                price=10 + i,
+                created_at=now - timedelta(seconds=i),
+                user_id=user.id,
+                category_id=category.id,
+            )
+            for i in range(count)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# what FastAPI does with the returned page: validate it into the response_model, dump it, encode it
+def default_path(db, rows: int) -> bytes:
+    page = db_advertisement.get_all_advertisements(db, None, rows)
+    content = AdvertisementPage.model_validate(page).model_dump(mode="json")
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def fast_path(db, rows: int) -> bytes:
+    return fast_json.dumps(db_advertisement.get_all_advertisements(db, None, rows, fast=True))
+
+
+def best_of(Session, build, rows: int, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        db = Session()
+        try:
+            started = time.perf_counter()
+            build(db, rows)
+            times.append(time.perf_counter() - started)
+        finally:
+            db.close()
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        Session = sessionmaker(bind=engine)
+        migrations.upgrade(engine)
+        seed(Session, max(args.rows))
+
+        db = Session()
+        try:
+            assert json.loads(default_path(db, 10)) == json.loads(fast_path(db, 10)), "the two paths disagree"
+        finally:
+            db.close()
+
+        encoder = "orjson" if fast_json.orjson is not None else "json"
+        print(f"fast path encoder: {encoder}")
+        print(f"{'rows':>7} {'default ms':>11} {'fast ms':>9} {'speedup':>8}")
+        for rows in args.rows:
+            default = best_of(Session, default_path, rows, args.repeat)
+            fast = best_of(Session, fast_path, rows, args.repeat)
+            print(f"{rows:>7} {default * 1000:>11.1f} {fast * 1000:>9.1f} {default / fast:>7.1f}x")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
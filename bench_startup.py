@@ -0,0 +1,59 @@
+# Cold-start time of a worker: a fresh interpreter importing main:app.
+#
+#   python bench_startup.py --runs 10
+#   python bench_startup.py --importtime   # slowest modules from python -X importtime
+#
+# Each run is a new process, so nothing is shared between runs except the OS file cache.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_APP = "from main import app"
+
+
+def cold_import_seconds() -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", IMPORT_APP], cwd=HERE, check=True)
+    return time.perf_counter() - started
+
+
+def slowest_imports(count: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_APP],
+        cwd=HERE, check=True, capture_output=True, text=True,
+    )
+    # lines look like: "import time:   self [us] | cumulative | imported package"
+    rows = []
+    for line in result.stderr.splitlines()[1:]:
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace(":", "|", 1).split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--importtime", action="store_true")
+    args = parser.parse_args()
+
+    if args.importtime:
+        print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+        for cumulative_us, self_us, name in slowest_imports(25):
+            print(f"{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}")
+        return
+
+    cold_import_seconds()  # warm the OS file cache
+    timings = [cold_import_seconds() for _ in range(args.runs)]
+    print(
+        f"import main:app over {args.runs} runs: "
+        f"median {statistics.median(timings) * 1000:.0f} ms, "
+        f"min {min(timings) * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
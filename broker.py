@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis is only needed when CHAT_BROKER_URL is set
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# redis://host:6379/0 to route chat messages between workers; unset keeps them inside this process
+CHAT_BROKER_URL = os.getenv("CHAT_BROKER_URL")
+
+Handler = Callable[[str], Awaitable[None]]
+
+
+def user_channel(user_id: int) -> str:
+    return f"chat:user:{user_id}"
+
+
+async def _dispatch(handlers: Set[Handler], message: str):
+    for handler in list(handlers):
+        try:
+            await handler(message)
+        except Exception:
+            logger.exception("Chat message handler failed")
+
+
+# delivers messages to subscribers in this process only; enough for a single worker
+class InProcessBroker:
+    def __init__(self):
+        self._handlers: Dict[str, Set[Handler]] = {}
+
+    # returns how many subscribers got the message
+    async def publish(self, channel: str, message: str) -> int:
+        handlers = self._handlers.get(channel, set())
+        await _dispatch(handlers, message)
+        return len(handlers)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel, set()).add(handler)
+
+    async def unsubscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.get(channel)
+        if handlers is not None:
+            handlers.discard(handler)
+            if not handlers:
+                del self._handlers[channel]
+
+    async def close(self):
+        self._handlers.clear()
+
+
+# routes messages through Redis pub/sub, so a message reaches its receiver whichever worker or node
+# holds the receiver's socket. Each worker keeps one pub/sub connection, subscribed to the channels
+# of the users connected to it, and one task handing incoming messages to the local handlers.
+class RedisBroker:
+    def __init__(self, url: Optional[str] = None, client=None):
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("CHAT_BROKER_URL needs the redis package (pip install redis)")
+            client = aioredis.from_url(url)
+        self.client = client
+        self._handlers: Dict[str, Set[Handler]] = {}
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    # returns how many workers subscribed to the channel got the message
+    async def publish(self, channel: str, message: str) -> int:
+        return await self.client.publish(channel, message)
+
+    async def subscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.setdefault(channel, set())
+        handlers.add(handler)
+        if len(handlers) > 1:
+            return
+        if self._pubsub is None:
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(channel)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+
+    async def unsubscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self._handlers[channel]
+            await self._pubsub.unsubscribe(channel)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost the chat broker connection, retrying")
+                await asyncio.sleep(1.0)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            channel, data = message["channel"], message["data"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            await _dispatch(self._handlers.get(channel, set()), data)
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._handlers.clear()
+        await self.client.aclose()
+
+
+def create_broker():
+    if CHAT_BROKER_URL:
+        return RedisBroker(CHAT_BROKER_URL)
+    return InProcessBroker()
+
+
+_broker = None
+
+
+# the configured broker, created on first use
+def get_broker():
+    global _broker
+    if _broker is None:
+        _broker = create_broker()
+    return _broker
+
+
+def set_broker(broker):
+    global _broker
+    _broker = broker
+
+
+async def close_broker():
+    global _broker
+    if _broker is not None:
+        await _broker.close()
+        _broker = None
@@ -5,7 +5,7 @@ from sqlalchemy.orm.session import Session
 
 from db import db_category
 from db.database import get_db
-from schemas import CategoryBase, CategoryDisplay
+from schemas import CategoryBase, CategoryDisplay, CategorySummary
 from utils.security import oauth2_scheme
 
 router=APIRouter(
@@ -20,4 +20,10 @@ def create_advertisement(request:CategoryBase,db:Session=Depends(get_db),token:
 
 @router.get('/all',response_model=List[CategoryDisplay])
 def get_all(db:Session=Depends(get_db)):
-    return db_category.get_all(db)
\ No newline at end of file
+    return db_category.get_all(db)
+
+
+# ad counts per category, served from memory; cheaper than /all, which loads every advertisement
+@router.get('/summary',response_model=List[CategorySummary])
+async def get_summary():
+    return await db_category.get_category_summary()
@@ -1,15 +1,36 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Dict, Optional, Set
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Depends, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
-from sqlalchemy.orm import Session
-from db.model import DbAdvertisement
-from db.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import db_message
+from db.database import get_async_db
+from db.db_advertisement import get_advertisement_owner
+from router.auth import get_current_user
+from schemas import MessagePage
+from utils.broker import get_broker, user_channel
+from utils.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 #begin Tina
 router=APIRouter(
     prefix='/chat',
     tags=["Messaging"]
 )
-active_connections = {}
+
+# outgoing messages each socket may have waiting; when a client does not keep up, further messages
+# are dropped ("drop") or the socket is closed ("close")
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "100"))
+CHAT_QUEUE_FULL_POLICY = os.getenv("CHAT_QUEUE_FULL_POLICY", "drop")
+CHAT_MAX_CONNECTIONS_PER_USER = int(os.getenv("CHAT_MAX_CONNECTIONS_PER_USER", "5"))
+CHAT_MAX_CONNECTIONS = int(os.getenv("CHAT_MAX_CONNECTIONS", "10000"))  # per worker
+
+# user id -> that user's open sockets on this worker
+active_connections: Dict[int, Set["ChatConnection"]] = {}
+_connection_count = 0
 
 chat_html = """
 <!DOCTYPE html>
@@ -28,7 +49,9 @@ chat_html = """
     <ul id="messages"></ul>
     <script>
         var senderId = {{user_id}};
-        var ws = new WebSocket("ws://" + location.host + "/chat/" + senderId);
+        // browsers cannot set headers on a WebSocket, so the access token (?token=... on this page) goes in the url
+        var token = new URLSearchParams(location.search).get("token") || "";
+        var ws = new WebSocket("ws://" + location.host + "/chat/" + senderId + "?token=" + encodeURIComponent(token));
 
         ws.onmessage = function(event) {
             var messages = document.getElementById('messages');
@@ -56,44 +79,175 @@ chat_html = """
 </html>
 """
 
+# past messages between the current user and another user about an advertisement, newest first
+@router.get("/history/{advertisement_id}", response_model=MessagePage)
+async def get_chat_history(
+    advertisement_id: int,
+    other_user_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db),
+    user_id: int = Depends(get_current_user),
+):
+    # include what this worker has not written yet, unless the database is too slow to take it now
+    await db_message.get_message_writer().flush(db_message.MESSAGE_FLUSH_TIMEOUT)
+    return await db.run_sync(lambda session: db_message.get_conversation(
+        session, advertisement_id, user_id, other_user_id, cursor, limit))
+
 @router.get("/{user_id}")
 async def get_chat_page(user_id: int):
     html = chat_html.replace("{{user_id}}", str(user_id))
     return HTMLResponse(html)
 
-@router.websocket("/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int, db: Session = Depends(get_db)):
-    await websocket.accept()
-    active_connections[user_id] = websocket
+# one chat socket. Everything sent to it goes through a bounded queue emptied by its own writer task,
+# so a slow client never holds up the sender, the broker, or the other sockets.
+class ChatConnection:
+    def __init__(self, websocket: WebSocket, user_id: int, on_sent=None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.on_sent = on_sent  # awaited with the mark of each chat message once it is sent
+        self.outbox = asyncio.Queue(maxsize=CHAT_SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.close_code = None
+        self._closing = asyncio.Event()
+
+    # queue a message; never waits for the client. A chat message carries its DeliveryMark, which is
+    # reported once it is sent, so one that is dropped or still queued at close stays undelivered.
+    def send(self, text: str, mark: Optional[db_message.DeliveryMark] = None):
+        try:
+            self.outbox.put_nowait((text, mark))
+        except asyncio.QueueFull:
+            if CHAT_QUEUE_FULL_POLICY == "close":
+                self.close(status.WS_1008_POLICY_VIOLATION)
+            else:
+                self.dropped += 1
+
+    def close(self, code: int):
+        self.close_code = code
+        self._closing.set()
+
+    async def _write(self):
+        while True:
+            text, mark = await self.outbox.get()
+            await self.websocket.send_text(text)
+            if mark is not None and self.on_sent is not None:
+                await self.on_sent(mark)
+
+    # run until the client disconnects or falls too far behind. Dead peers are found by the server's
+    # protocol-level pings (uvicorn --ws-ping-interval / --ws-ping-timeout), which every client answers.
+    async def run(self, receive):
+        tasks = [
+            asyncio.create_task(receive()),
+            asyncio.create_task(self._write()),
+            asyncio.create_task(self._closing.wait()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+        if self.close_code is not None:
+            try:
+                await self.websocket.close(code=self.close_code)
+            except Exception:
+                pass  # the client is already gone
+        for task in done:
+            error = None if task.cancelled() else task.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                raise error
+
+
+# the user id an access token belongs to, checked like get_current_user does for requests;
+# None when the token is missing, invalid, revoked or names no user
+async def _socket_user(websocket: WebSocket, token: Optional[str]) -> Optional[int]:
+    authorization = websocket.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[len("bearer "):]
+    if not token:
+        return None
     try:
+        return await get_current_user(token)
+    except HTTPException:
+        return None
+
+
+# messages go through the broker on the receiver's channel, so they reach the receiver's sockets
+# on whichever worker they are connected to; every message is stored, and the ones nobody received
+# are sent when the receiver connects again. The socket needs an access token of user_id, as the
+# token query parameter or a bearer Authorization header, before anything is sent or marked delivered.
+@router.websocket("/{user_id}")
+async def websocket_endpoint(websocket: WebSocket, user_id: int, token: Optional[str] = None):
+    global _connection_count
+    if await _socket_user(websocket, token) != user_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    connections = active_connections.setdefault(user_id, set())
+    if len(connections) >= CHAT_MAX_CONNECTIONS_PER_USER or _connection_count >= CHAT_MAX_CONNECTIONS:
+        if not connections:
+            del active_connections[user_id]
+        # accepted first: a close before the handshake is answered with HTTP 403 and the code is lost
+        await websocket.accept()
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    writer = db_message.get_message_writer()
+    connection = ChatConnection(websocket, user_id, on_sent=writer.confirm)
+    connections.add(connection)
+    _connection_count += 1
+    broker = get_broker()
+
+    async def deliver(payload: str):
+        connection.send(*db_message.unpack_message(payload))
+
+    async def receive():
         while True:
-            data = await websocket.receive_json()
-            receiver_id = int(data["receiver_id"])
-            ad_id = int(data["advertisement_id"])
-            message = data["message"]
+            try:
+                data = json.loads(await websocket.receive_text())
+                receiver_id = int(data["receiver_id"])
+                ad_id = int(data["advertisement_id"])
+                message = str(data["message"])
+            except (ValueError, TypeError, KeyError):
+                connection.send("Error: Expected a JSON object with receiver_id, advertisement_id and message.")
+                continue
 
             # Prevent users from messaging themselves
             if user_id == receiver_id:
-                await websocket.send_text("Error: You cannot send messages to yourself.")
+                connection.send("Error: You cannot send messages to yourself.")
                 continue  # Skip this message
             
-            # Only deliver if receiver owns the ad
-            ad = db.query(DbAdvertisement).filter_by(id=ad_id, user_id=receiver_id).first()
-            if ad and receiver_id in active_connections:
-                await active_connections[receiver_id].send_text(
-                    f"User {user_id} (ad {ad_id}): {message}"
-                )
-
-            # Allow seller (ad owner) to reply to buyer (about their own ad)
-            # Check if the sender is the ad owner and the receiver is the other user
-            elif (
-                db.query(DbAdvertisement).filter_by(id=ad_id, user_id=user_id).first()
-                and receiver_id in active_connections
-            ):
-                await active_connections[receiver_id].send_text(
-                    f"User {user_id} (ad {ad_id}): {message}"
-                )
+            # Only deliver if receiver owns the ad,
+            # or allow seller (ad owner) to reply to buyer (about their own ad)
+            if await get_advertisement_owner(ad_id) in (receiver_id, user_id):
+                # stamped before it is published: a socket replaying missed messages skips the ones
+                # created after it subscribed, which reach it live. It is stored undelivered; the
+                # receiver's socket marks it delivered once it has actually sent it.
+                row = db_message.new_message(ad_id, user_id, receiver_id, message, delivered=False)
+                await writer.write(row)
+                await broker.publish(user_channel(receiver_id), db_message.pack_message(row))
+
+    try:
+        await websocket.accept()
+        subscribed_at = datetime.utcnow()
+        await broker.subscribe(user_channel(user_id), deliver)
+        # missed messages go out before the writer starts, so the outbox limit does not apply to them;
+        # each counts as delivered only once it is sent, and the ones sent from now on come live
+        await writer.flush(db_message.MESSAGE_FLUSH_TIMEOUT)
+        sent = []
+        try:
+            for message_id, text in await run_in_threadpool(db_message.load_undelivered, user_id, subscribed_at):
+                await websocket.send_text(text)
+                sent.append(message_id)
+        finally:
+            if sent:
+                await run_in_threadpool(db_message.mark_delivered, sent)
+        await connection.run(receive)
     except WebSocketDisconnect:
-        del active_connections[user_id]
+        pass
+    finally:
+        await broker.unsubscribe(user_channel(user_id), deliver)
+        connections.discard(connection)
+        _connection_count -= 1
+        if not connections and active_connections.get(user_id) is connections:
+            del active_connections[user_id]
         
 #end Tina
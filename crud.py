@@ -2,6 +2,7 @@
 from fastapi import HTTPException
 from sqlalchemy.orm import Session
 from db.model import DbRating, DbTransaction
+from db.db_rating_stats import add_seller_rating
 from schemas import RatingCreate
 
 def create_rating(db: Session, rating: RatingCreate, current_user: int):
@@ -40,6 +41,8 @@ def create_rating(db: Session, rating: RatingCreate, current_user: int):
         comment=rating.comment
     )
     db.add(new_rating)
+    if ratee_id == transaction.seller_id:
+        add_seller_rating(db, ratee_id, rating.score)
     db.commit()
     db.refresh(new_rating)
     return new_rating
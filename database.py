@@ -1,21 +1,86 @@
-from sqlalchemy import MetaData, create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 
-SQLALCHEMY_DATABASE_URL = 'sqlite:///./marketplace.db'
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True )
+
+# connection settings, overridable from the environment
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", 'sqlite:///./marketplace.db')
+# same database through an async driver (postgresql+asyncpg://... in production)
+ASYNC_SQLALCHEMY_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", 'sqlite+aiosqlite:///./marketplace.db')
+DB_ECHO = _env_flag("DB_ECHO", False)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", True)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# schema changes run from `python manage.py migrate`; set this to also run them on app startup
+DB_AUTO_MIGRATE = _env_flag("DB_AUTO_MIGRATE", False)
+
+
+# WAL lets readers run alongside the single writer; busy_timeout makes writers wait for
+# the lock instead of failing with "database is locked"
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KIB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+# builds the sync or async engine for a url from the settings above
+def create_db_engine(url: str, is_async: bool = False, **overrides):
+    options = {
+        "echo": DB_ECHO,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite":
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    elif parsed.database and parsed.database != ":memory:":
+        # the default pool of file-backed SQLite differs between SQLAlchemy releases (aiosqlite got
+        # NullPool before 2.0.38), so a queue pool is asked for explicitly before it is sized; in-memory
+        # SQLite uses a single shared connection, which takes no pool sizing
+        options.update(poolclass=AsyncAdaptedQueuePool if is_async else QueuePool, pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    options.update(overrides)
+
+    db_engine = create_async_engine(url, **options) if is_async else create_engine(url, **options)
+    if db_engine.dialect.name == "sqlite":
+        event.listen(db_engine.sync_engine if is_async else db_engine, "connect", _set_sqlite_pragmas)
+    return db_engine
+
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
 Base = declarative_base()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-#begin Nataliia
-metadata = MetaData()
-metadata.reflect(bind=engine) 
-#end Nataliia
+async_engine = create_db_engine(ASYNC_SQLALCHEMY_DATABASE_URL, is_async=True)
+# objects stay usable after commit: serializing them must not trigger a refresh outside the session
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()  
+        db.close()
+
+
+# async routes: await db.run_sync(lambda session: db_module.function(..., session)) runs the
+# sync ORM code of the db_* modules on the async driver without blocking the event loop
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
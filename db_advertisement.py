@@ -1,41 +1,109 @@
 import os
 import shutil
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
-from sqlalchemy.orm.session import Session
+from sqlalchemy.orm import Session, joinedload, selectinload
+from datetime import datetime
 from typing import Optional
 from fastapi import HTTPException, UploadFile, status
-from db.model import DbAdvertisement, DbCategory, DbImage, DbUser, DbRating, DbTransaction
+from fastapi.concurrency import run_in_threadpool
+from db.database import SessionLocal
+from db.model import DbAdvertisement, DbCategory, DbImage, DbUser, DbSellerRatingStats
+from db import db_search
+from db.db_category import forget_category_summary, move_advertisement_count
+from db import db_image  # registers the image blob release on cascade deletes
 
 from schemas import (
     AdvertisementBase,
     AdvertisementEditBase,
+    AdvertisementSortEnum,
     AdvertisementStatusDisplay,
     StatusChangeAdvertisementEnum,
     User,
 )
 from router.auth import get_current_user
+from utils.cache import TTLCache
+from utils.pagination import DEFAULT_PAGE_SIZE, decode_cursor, encode_cursor, keyset_filter
+
+# relationships serialized by AdvertisementDisplay / AdvertisementOneDisplay, loaded up front
+# so a page of N ads costs a fixed number of statements instead of 2N+1 lazy loads
+LISTING_LOAD_OPTIONS = (
+    joinedload(DbAdvertisement.user),
+    joinedload(DbAdvertisement.category),
+)
+ONE_ADVERTISEMENT_LOAD_OPTIONS = LISTING_LOAD_OPTIONS + (
+    selectinload(DbAdvertisement.images),
+)
+# the fields of AdvertisementDisplay as plain columns, for listing pages built without ORM objects
+LISTING_COLUMNS = (
+    DbAdvertisement.id,
+    DbAdvertisement.title,
+    DbAdvertisement.content,
+    DbAdvertisement.price,
+    DbAdvertisement.status,
+    DbAdvertisement.created_at,
+    DbUser.username,
+    DbUser.email,
+    DbUser.address,
+    DbUser.phone,
+    DbCategory.title.label("category_title"),
+)
+
+# advertisement id -> owner id, for the chat socket's per-message permission check. Edits, deletes and
+# status changes on this worker drop the entry; the ttl bounds staleness from the other workers.
+AD_OWNER_CACHE_SIZE = int(os.getenv("AD_OWNER_CACHE_SIZE", "100000"))
+AD_OWNER_CACHE_TTL = float(os.getenv("AD_OWNER_CACHE_TTL", "60"))
+_MISSING_AD_TTL = 5.0  # unknown ids are remembered briefly, in case the ad is being created
+_ad_owners = TTLCache(AD_OWNER_CACHE_SIZE, AD_OWNER_CACHE_TTL)
+_NOT_CACHED = object()
+
+
+def _load_advertisement_owner(id: int) -> Optional[int]:
+    db = SessionLocal()
+    try:
+        return db.query(DbAdvertisement.user_id).filter(DbAdvertisement.id == id).scalar()
+    finally:
+        db.close()
+
+
+# owner of an advertisement, or None if there is no such ad; a cache miss runs one short query on the threadpool
+async def get_advertisement_owner(id: int) -> Optional[int]:
+    owner = _ad_owners.get(id, _NOT_CACHED)
+    if owner is _NOT_CACHED:
+        owner = await run_in_threadpool(_load_advertisement_owner, id)
+        _ad_owners.set(id, owner, None if owner is not None else _MISSING_AD_TTL)
+    return owner
+
+
+def forget_advertisement_owner(id: int):
+    _ad_owners.pop(id)
+
 
 # -----------search for desired ads by searching on keyword and filtering by category_id--------
-# -----------------------the result is sorted by recency and rating------------------------------
+# ------------the result is sorted by recency, or by bm25 relevance to the keyword---------------
 def get_filtered_advertisements(
-    db: Session, keyword: Optional[str] = None, category_id: Optional[int] = None
+    db: Session,
+    keyword: Optional[str] = None,
+    category_id: Optional[int] = None,
+    sort: AdvertisementSortEnum = AdvertisementSortEnum.RECENT,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    fast: bool = False,
 ):
-    subquery = (
-        db.query(
-            DbAdvertisement.user_id.label("seller_id"),
-            func.avg(DbRating.score).label("avg_seller_score"),
-        )
-        .join(DbTransaction, DbTransaction.advertisement_id == DbAdvertisement.id)
-        .join(DbRating, DbRating.transaction_id == DbTransaction.id)
-        .where(DbRating.ratee_id == DbTransaction.seller_id)
-        .group_by(DbAdvertisement.user_id)
-        .subquery()
-    )
-    query = db.query(DbAdvertisement, subquery.c.avg_seller_score).outerjoin(
-        subquery, DbAdvertisement.user_id == subquery.c.seller_id
-    )
+    match = None
     if keyword:
+        match_query = db_search.build_match_query(keyword)
+        if match_query and db_search.has_search_index(db.get_bind()):
+            # served by the FTS5 index instead of scanning every title/content
+            match = db_search.match_subquery(match_query)
+
+    if match is not None and sort == AdvertisementSortEnum.RELEVANCE:
+        sort_key, sort_type, descending = match.c.rank, float, False
+    else:
+        sort_key, sort_type, descending = DbAdvertisement.created_at, datetime, True
+
+    query = _listing_query(db, sort_key, fast)
+    if match is not None:
+        query = query.join(match, match.c.advertisement_id == DbAdvertisement.id)
+    elif keyword:
         query = query.filter(
             DbAdvertisement.title.ilike(f"%{keyword}%")
             | DbAdvertisement.content.ilike(f"%{keyword}%")
@@ -44,14 +112,63 @@ def get_filtered_advertisements(
     if category_id:
         query = query.filter(DbAdvertisement.category_id == category_id)
 
-    ads = query.order_by(
-        DbAdvertisement.created_at.desc(),
-        subquery.c.avg_seller_score.desc().nullslast(),
-    ).all()
+    return _advertisement_page(query, sort_key, sort_type, descending, cursor, limit, fast)
+
+
+# rows of (advertisement, average_rating, sort_key), or with fast=True (*LISTING_COLUMNS, average_rating, sort_key)
+def _listing_query(db: Session, sort_key, fast: bool):
+    if fast:
+        query = (
+            db.query(*LISTING_COLUMNS, DbSellerRatingStats.average_rating, sort_key)
+            .select_from(DbAdvertisement)
+            .join(DbUser, DbAdvertisement.user_id == DbUser.id)
+            .outerjoin(DbCategory, DbAdvertisement.category_id == DbCategory.id)
+        )
+    else:
+        query = db.query(DbAdvertisement, DbSellerRatingStats.average_rating, sort_key).options(*LISTING_LOAD_OPTIONS)
+    return query.outerjoin(DbSellerRatingStats, DbAdvertisement.user_id == DbSellerRatingStats.seller_id)
+
+
+# one AdvertisementWithRating as plain data, from a fast listing row
+def _listing_item(row) -> dict:
+    return {
+        "advertisement": {
+            "title": row.title,
+            "content": row.content,
+            "price": row.price,
+            "status": row.status,
+            "created_at": row.created_at,
+            "user": {"username": row.username, "email": row.email, "address": row.address, "phone": row.phone},
+            "category": {"title": row.category_title},
+        },
+        "average_rating": row.average_rating or 0,
+    }
+
+
+# one page of listing rows after the cursor, plus the cursor of the next page; with fast=True the
+# items are plain dicts ready for fast_json, otherwise ORM objects for AdvertisementPage
+def _advertisement_page(query, sort_key, sort_type, descending: bool, cursor: Optional[str], limit: int, fast: bool = False):
+    if cursor:
+        last_key, last_id = decode_cursor(cursor, (sort_type, int))
+        query = query.filter(keyset_filter(sort_key, DbAdvertisement.id, last_key, last_id, descending))
+
+    ads = (
+        query.order_by(sort_key.desc() if descending else sort_key.asc(), DbAdvertisement.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    next_cursor = None
+    if len(ads) > limit:
+        ads = ads[:limit]
+        last = ads[-1]
+        next_cursor = encode_cursor(last[-1], last.id if fast else last[0].id)
 
-    return [
-        {"advertisement": ad, "average_rating": avg_score or 0} for ad, avg_score in ads
-    ]
+    if fast:
+        items = [_listing_item(row) for row in ads]
+    else:
+        items = [{"advertisement": ad, "average_rating": avg_score or 0} for ad, avg_score, _ in ads]
+    return {"items": items, "next_cursor": next_cursor}
 
 
 # creating one advertisement
@@ -78,42 +195,29 @@ def create_advertisement(db: Session, request: AdvertisementBase,current_user_id
         category_id=request.category_id,
     )
     db.add(new_adv)
+    move_advertisement_count(db, None, None, new_adv.category_id, new_adv.status)
     db.commit()
+    forget_category_summary()
     db.refresh(new_adv)
     return new_adv
 
 
-# selecting all advertisements
-def get_all_advertisements(db: Session):
-    subquery = (
-        db.query(
-            DbAdvertisement.user_id.label("seller_id"),
-            func.avg(DbRating.score).label("avg_seller_score"),
-        )
-        .join(DbTransaction, DbTransaction.advertisement_id == DbAdvertisement.id)
-        .join(DbRating, DbRating.transaction_id == DbTransaction.id)
-        .where(DbRating.ratee_id == DbTransaction.seller_id)
-        .group_by(DbAdvertisement.user_id)
-        .subquery()
-    )
+# selecting all advertisements, newest first, one page at a time
+def get_all_advertisements(db: Session, cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE, fast: bool = False):
+    # Main query to get ads and join with the maintained avg score per seller
+    query = _listing_query(db, DbAdvertisement.created_at, fast)
 
-    # Main query to get ads and join with avg score per seller
-    ads = (
-        db.query(DbAdvertisement, subquery.c.avg_seller_score)
-        .outerjoin(subquery, DbAdvertisement.user_id == subquery.c.seller_id)
-        .order_by(
-            DbAdvertisement.created_at.desc(),
-            subquery.c.avg_seller_score.desc().nullslast(),
-        )
-        .all()
-    )
-
-    return [{"advertisement": ad, "average_rating": avg_score or 0} for ad, avg_score in ads]
+    return _advertisement_page(query, DbAdvertisement.created_at, datetime, True, cursor, limit, fast)
 
 
 # selecting one  advertisement
 def get_one_advertisement(id: int, db: Session):
-    advertisement = db.query(DbAdvertisement).filter(DbAdvertisement.id == id).first()
+    advertisement = (
+        db.query(DbAdvertisement)
+        .options(*ONE_ADVERTISEMENT_LOAD_OPTIONS)
+        .filter(DbAdvertisement.id == id)
+        .first()
+    )
     if not advertisement:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -134,6 +238,7 @@ def edit_advertisement(id: int, request: AdvertisementEditBase, db: Session,curr
          raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                              detail=f'User  with id {current_user_id} has no write access to make changes to this record')        
     
+    old_category_id, old_status = advertisement.category_id, advertisement.status
     update_data = request.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         if getattr(advertisement, key) != value:
@@ -147,7 +252,10 @@ def edit_advertisement(id: int, request: AdvertisementEditBase, db: Session,curr
                       raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Price should be more than 0")
             setattr(advertisement, key, value)
+    move_advertisement_count(db, old_category_id, old_status, advertisement.category_id, advertisement.status)
     db.commit()
+    forget_advertisement_owner(id)
+    forget_category_summary()
     db.refresh(advertisement)
     return  advertisement
     
@@ -165,8 +273,11 @@ def delete_advertisement(id: int, db: Session,current_user_id:int):
          raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                              detail=f'User  with id {current_user_id} has no write access to make changes to this record')        
    
+    move_advertisement_count(db, advertisement.category_id, advertisement.status, None, None)
     db.delete(advertisement)
     db.commit()
+    forget_advertisement_owner(id)
+    forget_category_summary()
     return {"message": f"Advertisement with id {id} has been deleted"}
 
 
@@ -182,8 +293,11 @@ def status_advertisement(id: int, request: StatusChangeAdvertisementEnum, db: Se
          raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                              detail=f'User  with id {current_user_id} has no write access to make changes to this record')        
    
+    move_advertisement_count(db, advertisement.category_id, advertisement.status, advertisement.category_id, request.status)
     advertisement.status = request.status
     db.commit()
+    forget_advertisement_owner(id)
+    forget_category_summary()
     db.refresh(advertisement)
     return advertisement
 
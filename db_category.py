@@ -1,16 +1,100 @@
+import os
+from typing import Dict, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, select, update
 from sqlalchemy.orm.session import Session
-from db.database import get_db
-from db.model import DbCategory
-from schemas import CategoryBase
+from db.database import SessionLocal, get_db
+from db.model import DbAdvertisement, DbCategory, StatusAdvertisementEnum
+from schemas import CategoryBase, CategorySummary
+from utils.cache import TTLCache
+
+# the category list with its ad counts, read from the maintained counters and kept in memory.
+# Writes on this worker drop it; the ttl bounds staleness from the other workers.
+CATEGORY_SUMMARY_TTL = float(os.getenv("CATEGORY_SUMMARY_TTL", "30"))
+_summary_cache = TTLCache(1, CATEGORY_SUMMARY_TTL)
 
 
 def create_category(db: Session, request: CategoryBase):
     new_category = DbCategory(title=request.title)
     db.add(new_category)
     db.commit()
+    forget_category_summary()
     db.refresh(new_category)
     return new_category
 
 
 def get_all(db: Session):
     return db.query(DbCategory).all()
+
+
+def _load_category_summary() -> list:
+    db = SessionLocal()
+    try:
+        rows = db.query(
+            DbCategory.id, DbCategory.title, DbCategory.advertisement_count, DbCategory.open_advertisement_count
+        ).order_by(DbCategory.title, DbCategory.id).all()
+        return [CategorySummary.model_validate(row) for row in rows]
+    finally:
+        db.close()
+
+
+# every category with its ad counts; a cache miss runs one query on the threadpool
+async def get_category_summary() -> list:
+    summary = _summary_cache.get("all")
+    if summary is None:
+        summary = await run_in_threadpool(_load_category_summary)
+        _summary_cache.set("all", summary)
+    return summary
+
+
+# call after committing anything that changes categories or their advertisements
+def forget_category_summary():
+    _summary_cache.clear()
+
+
+def _adjust_counts(db: Session, category_id: Optional[int], total: int, open_count: int):
+    if category_id is None or not (total or open_count):
+        return
+    db.execute(
+        update(DbCategory)
+        .where(DbCategory.id == category_id)
+        .values(
+            advertisement_count=DbCategory.advertisement_count + total,
+            open_advertisement_count=DbCategory.open_advertisement_count + open_count,
+        )
+    )
+
+
+# keep the category counters in step with one advertisement moving from (old category, old status)
+# to (new category, new status); None on the old side is a new ad, on the new side a deleted one.
+# Runs inside the caller's transaction (no commit).
+def move_advertisement_count(db: Session, old_category_id: Optional[int], old_status, new_category_id: Optional[int], new_status):
+    old_open = int(old_status == StatusAdvertisementEnum.OPEN)
+    new_open = int(new_status == StatusAdvertisementEnum.OPEN)
+    if old_category_id == new_category_id:
+        _adjust_counts(db, new_category_id, 0, new_open - old_open)
+    else:
+        _adjust_counts(db, old_category_id, -1, -old_open)
+        _adjust_counts(db, new_category_id, 1, new_open)
+
+
+# bulk form for imports: category id -> (advertisements added, of which open), one UPDATE per category.
+# Runs inside the caller's transaction (no commit).
+def add_advertisement_counts(db: Session, counts: Dict[int, Tuple[int, int]]):
+    for category_id, (total, open_count) in counts.items():
+        _adjust_counts(db, category_id, total, open_count)
+
+
+# recompute every category's counters from the advertisements table (backfills and repairs)
+def rebuild_category_counts(db: Session) -> int:
+    ads = DbAdvertisement.__table__
+    total = select(func.count()).where(ads.c.category_id == DbCategory.id).scalar_subquery()
+    open_count = (
+        select(func.count())
+        .where(ads.c.category_id == DbCategory.id, ads.c.status == StatusAdvertisementEnum.OPEN)
+        .scalar_subquery()
+    )
+    db.execute(update(DbCategory).values(advertisement_count=total, open_advertisement_count=open_count))
+    db.commit()
+    forget_category_summary()
+    return db.query(func.count(DbCategory.id)).scalar()
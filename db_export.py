@@ -0,0 +1,63 @@
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional
+from sqlalchemy import select
+from db.database import SessionLocal
+from db.model import DbAdvertisement, DbCategory
+from utils import fast_json
+
+# rows fetched per round trip; memory use depends on this, not on the size of the catalogue
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# timestamps are taken when a row is flushed, not when it commits, so a write can show up with a time
+# older than the last export that missed it; since goes back this many seconds to pick such rows up
+EXPORT_SINCE_OVERLAP = float(os.getenv("EXPORT_SINCE_OVERLAP", "60"))
+
+EXPORT_COLUMNS = (
+    DbAdvertisement.id,
+    DbAdvertisement.title,
+    DbAdvertisement.content,
+    DbAdvertisement.price,
+    DbAdvertisement.status,
+    DbAdvertisement.user_id,
+    DbAdvertisement.category_id,
+    DbCategory.title.label("category"),
+    DbAdvertisement.created_at,
+    DbAdvertisement.updated_at,
+)
+
+
+# advertisements as NDJSON, one chunk per batch, oldest first by since_field ("created_at" or "updated_at");
+# with since, only those created/updated at or after since - overlap seconds. Incremental exports therefore
+# repeat some rows (every row at the boundary timestamp, and those in the overlap): consumers upsert by id
+# and pass the newest since_field value they have seen as the next since. Rows are streamed from a
+# server-side cursor as plain tuples, so no batch outlives the next one.
+def export_advertisements(since: Optional[datetime] = None, since_field: str = "updated_at",
+                          batch_size: int = EXPORT_BATCH_SIZE, overlap: Optional[float] = None) -> Iterator[bytes]:
+    order_column = getattr(DbAdvertisement, since_field)
+    query = (
+        select(*EXPORT_COLUMNS)
+        .outerjoin(DbCategory, DbAdvertisement.category_id == DbCategory.id)
+        .order_by(order_column, DbAdvertisement.id)
+        .execution_options(yield_per=batch_size)
+    )
+    if since is not None:
+        overlap = EXPORT_SINCE_OVERLAP if overlap is None else overlap
+        query = query.where(order_column >= since - timedelta(seconds=overlap))
+
+    db = SessionLocal()
+    try:
+        for rows in db.execute(query).partitions():
+            yield b"".join(fast_json.dumps(row._asdict()) + b"\n" for row in rows)
+    finally:
+        db.close()
+
+
+# gzip-compresses a stream of chunks as it goes
+def gzip_stream(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
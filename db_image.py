@@ -1,16 +1,42 @@
+import mimetypes
 import os
-import shutil
-import uuid
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from fastapi import HTTPException, UploadFile, status
-from db.model import DbAdvertisement, DbImage
-from schemas import ImageOrderDisplay, ImageAllDisplay
- 
-UPLOAD_DIR = "uploaded_images"
- 
-# add images to advertisement
-def add_image(id: int,image: UploadFile, db: Session, current_user_id: int):
+from datetime import datetime
+from typing import AsyncIterator, Optional
+from sqlalchemy import delete, event, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, object_session
+from urllib.parse import quote
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from db.model import DbAdvertisement, DbImage, DbImageBlob
+from schemas import ImageOrderDisplay, ImageAllDisplay, ImageOneDisplay, ImageUploadConfirm, ImageUploadRequest, ImageUploadTicket
+from utils import image_processing, uploads
+from utils.cache import TTLCache
+from utils.storage import UPLOAD_DIR, get_storage
+from utils.uploads import discard_upload, receive_upload
+ 
+
+# image id -> (file name, media type) for show_image, so repeat views skip the database; the ttl
+# bounds how long another worker can keep serving an image deleted elsewhere
+IMAGE_LOCATION_CACHE_SIZE = int(os.getenv("IMAGE_LOCATION_CACHE_SIZE", "10000"))
+IMAGE_LOCATION_CACHE_TTL = float(os.getenv("IMAGE_LOCATION_CACHE_TTL", "300"))
+_image_locations = TTLCache(IMAGE_LOCATION_CACHE_SIZE, IMAGE_LOCATION_CACHE_TTL)
+
+
+# public urls of an image and its resized variants, falling back to the original until they are ready
+def _set_display_urls(image: DbImage):
+    storage = get_storage()
+    image.image_path = storage.public_url(image.image_name)
+    variants = image.blob.variants if image.blob_sha256 else image.variants
+    ready = set(variants.split(",")) if variants else set()
+    for variant in image_processing.VARIANTS:
+        name = image_processing.variant_name(image.image_name, variant) if variant in ready else image.image_name
+        setattr(image, f"{variant}_url", storage.public_url(name))
+ 
+# checks for adding an image to an advertisement, made before the upload is read; _record_image
+# checks the limit again when it inserts the row
+def _next_image_order(id: int, filename: str, db: Session, current_user_id: int) -> int:
     advertisement = db.query(DbAdvertisement).filter(DbAdvertisement.id == id).first()
     if not advertisement:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -20,13 +46,18 @@ def add_image(id: int,image: UploadFile, db: Session, current_user_id: int):
                             detail='No permission to modify this advertisement')
  
     ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif"}
-    name, ext = os.path.splitext(image.filename)
+    name, ext = os.path.splitext(filename)
     if ext.lower() not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Unsupported image format: {ext}. Allowed formats are: {', '.join(ALLOWED_EXTENSIONS)}"
         )
  
+    return _next_order_id(id, db)
+
+
+# the order_id after the advertisement's last image, or 400 once it has MAX_NUMBER of them
+def _next_order_id(id: int, db: Session) -> int:
     max_order = (
         db.query(func.max(DbImage.order_id))
         .filter(DbImage.advertisement_id == id)
@@ -41,39 +72,200 @@ def add_image(id: int,image: UploadFile, db: Session, current_user_id: int):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"There is limit of images: {MAX_NUMBER}"
         )      
-   
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
- 
-    name, ext = os.path.splitext(image.filename)
-    unique_filename = f"{name}_{uuid.uuid4().hex}{ext}"
-    image_path = os.path.join(UPLOAD_DIR, unique_filename)
- 
-    with open(image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
- 
-    image_record = DbImage(
-        order_id=max_order+1,
-        original_name=image.filename,
-        image_name=unique_filename,
-        image_path=image_path,
-        image_type=image.content_type,
-        advertisement_id=id
-    )
-    db.add(image_record)
-    db.commit()
+    return max_order+1
+
+
+# makes sure file_name is in storage, saving it from source_path when it is not. Storage calls are network
+# round trips with a bucket, so this runs on the threadpool, never inside run_sync on the event loop.
+def _ensure_stored(file_name: str, content_type: Optional[str], source_path: Optional[str]) -> bool:
+    storage = get_storage()
+    if storage.size(file_name) is not None:
+        return False
+    if not source_path or not os.path.exists(source_path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f'Upload {file_name} not found in storage')
+    storage.save(source_path, file_name, content_type)
+    return True
+
+
+# add the DbImage row for a file already in storage, sharing the blob when one exists;
+# a concurrent upload of the same content may create the blob first, then the row shares it.
+# The advertisement row is written first, so uploads to one advertisement take turns here and the
+# order_id and the image limit are worked out from the images committed before this one.
+# Database work only: the caller has checked with _ensure_stored that the file is in storage.
+def _record_image(id: int, filename: str, content_type: Optional[str],
+                  sha256: str, file_name: str, size: int, db: Session):
+    for attempt in range(2):
+        touched = db.execute(update(DbAdvertisement).where(DbAdvertisement.id == id)
+                             .values(updated_at=datetime.utcnow())).rowcount
+        if not touched:
+            db.rollback()
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Advertisement with id {id} not found')
+        try:
+            order_id = _next_order_id(id, db)
+        except HTTPException:
+            db.rollback()
+            raise
+        blob = db.get(DbImageBlob, sha256)
+        new_blob = blob is None
+        if new_blob:
+            blob = DbImageBlob(sha256=sha256, file_name=file_name, size=size, ref_count=1)
+            db.add(blob)
+        else:
+            blob.ref_count = DbImageBlob.ref_count + 1
+        image_record = DbImage(
+            order_id=order_id,
+            original_name=filename,
+            image_name=blob.file_name,
+            image_path=os.path.join(UPLOAD_DIR, blob.file_name),
+            image_type=content_type if content_type and content_type.startswith("image/") else mimetypes.guess_type(filename)[0],
+            advertisement_id=id,
+            blob_sha256=sha256
+        )
+        db.add(image_record)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            if attempt:
+                raise
     db.refresh(image_record)
+    if new_blob:
+        image_processing.submit_variants(sha256, image_record.image_name)
+    _set_display_urls(image_record)
+    return ImageOneDisplay.model_validate(image_record)
+
+
+# add images to advertisement: the checks run before the body is read, the body is streamed
+# to a temp file without holding a database connection, and the record is written once the file is stored.
+# Files are named by the SHA-256 of their content, so the same photo is stored once however often it is uploaded.
+async def add_image(id: int, filename: str, content_type: Optional[str], chunks: AsyncIterator[bytes],
+                    db: AsyncSession, current_user_id: int):
+    await db.run_sync(lambda session: _next_image_order(id, filename, session, current_user_id))
+    await db.rollback()  # give the connection back while the upload streams in
  
-    return image_record
+    name, ext = os.path.splitext(filename)
+    upload = await receive_upload(chunks, UPLOAD_DIR, ext.lower())
+    file_name = f"{upload.sha256}{ext.lower()}"
+    try:
+        stored = await db.run_sync(lambda session: session.scalar(
+            select(DbImageBlob.file_name).where(DbImageBlob.sha256 == upload.sha256)))
+        await db.rollback()
+        file_name = stored or file_name
+        # checked even when the blob exists: it may have lost its last reference, and its file, meanwhile
+        saved = await run_in_threadpool(_ensure_stored, file_name, content_type, upload.temp_path)
+        try:
+            return await db.run_sync(lambda session: _record_image(
+                id, filename, content_type, upload.sha256, file_name, upload.size, session))
+        except BaseException:
+            # a file saved for a row that never got written; the removal skips it if a blob has it by then
+            if saved:
+                image_processing.submit_removal(file_name)
+            raise
+    finally:
+        discard_upload(upload.temp_path)
+
+
+# first step of a direct upload: where to send the bytes, or that they are stored already
+def request_image_upload(id: int, request: ImageUploadRequest, db: Session, current_user_id: int):
+    _next_image_order(id, request.filename, db, current_user_id)
+    if request.size > uploads.MAX_IMAGE_UPLOAD_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"Image is larger than {uploads.MAX_IMAGE_UPLOAD_BYTES} bytes")
+    ext = os.path.splitext(request.filename)[1].lower()
+    blob = db.get(DbImageBlob, request.sha256)
+    if blob:
+        return ImageUploadTicket(file_name=blob.file_name, already_stored=True)
+ 
+    file_name = f"{request.sha256}{ext}"
+    content_type = request.content_type or mimetypes.guess_type(request.filename)[0]
+    ticket = get_storage().presigned_upload(file_name, content_type, request.sha256)
+    if ticket is None:  # the backend takes no direct uploads; the bytes go through the API
+        return ImageUploadTicket(
+            file_name=file_name, already_stored=False, method="PUT", confirm=False,
+            url=f"/advertisements/{id}/upload_image?filename={quote(request.filename)}",
+            headers={"Content-Type": content_type},
+        )
+    return ImageUploadTicket(file_name=file_name, already_stored=False, **ticket)
+
+
+# second step of a direct upload: check what arrived in storage and record the image
+async def confirm_image_upload(id: int, confirmation: ImageUploadConfirm, db: AsyncSession, current_user_id: int):
+    await db.run_sync(lambda session: _next_image_order(id, confirmation.filename, session, current_user_id))
+    blob = await db.run_sync(lambda session: session.get(DbImageBlob, confirmation.sha256))
+    await db.rollback()  # storage is checked without holding a connection
  
-#show one image related to specific advertisement
+    ext = os.path.splitext(confirmation.filename)[1].lower()
+    file_name = blob.file_name if blob else f"{confirmation.sha256}{ext}"
+    size = blob.size if blob else None
+    if not blob:
+        storage = get_storage()
+        size = await run_in_threadpool(storage.size, file_name)
+        if size is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f'Upload {file_name} not found in storage')
+        try:
+            if size > uploads.MAX_IMAGE_UPLOAD_BYTES:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"Image is larger than {uploads.MAX_IMAGE_UPLOAD_BYTES} bytes")
+            uploads.check_magic(await run_in_threadpool(storage.read_head, file_name, uploads.MAGIC_LENGTH), ext)
+        except HTTPException:
+            await run_in_threadpool(storage.delete, file_name)
+            raise
+    else:  # the blob may have lost its last reference, and its file, since it was looked up
+        await run_in_threadpool(_ensure_stored, file_name, None, None)
+    return await db.run_sync(lambda session: _record_image(
+        id, confirmation.filename, mimetypes.guess_type(confirmation.filename)[0],
+        confirmation.sha256, file_name, size, session))
+ 
+ 
+# DbImage rows are deleted by delete_image and by the advertisement and user cascades; each one gives
+# back its reference to the blob, and the last reference removes the blob and, after commit, its files.
+# Images from before blobs own their file, which goes after commit too, so a failed commit keeps it.
+RELEASED_BLOB_FILES = "released_blob_files"
+ 
+@event.listens_for(DbImage, "after_delete")
+def _release_blob(mapper, connection, target: DbImage):
+    _image_locations.pop(target.id)
+    if not target.blob_sha256:
+        object_session(target).info.setdefault(RELEASED_BLOB_FILES, []).append(os.path.basename(target.image_path))
+        return
+    blobs = DbImageBlob.__table__
+    this_blob = blobs.c.sha256 == target.blob_sha256
+    connection.execute(update(blobs).where(this_blob).values(ref_count=blobs.c.ref_count - 1))
+    blob = connection.execute(select(blobs.c.file_name, blobs.c.ref_count).where(this_blob)).first()
+    if blob and blob.ref_count <= 0:
+        connection.execute(delete(blobs).where(this_blob))
+        object_session(target).info.setdefault(RELEASED_BLOB_FILES, []).append(blob.file_name)
+ 
+@event.listens_for(Session, "after_commit")
+def _remove_released_blob_files(session: Session):
+    for file_name in session.info.pop(RELEASED_BLOB_FILES, []):
+        image_processing.submit_removal(file_name)
+ 
+@event.listens_for(Session, "after_rollback")
+def _keep_released_blob_files(session: Session):
+    session.info.pop(RELEASED_BLOB_FILES, None)
+ 
+#show one image related to specific advertisement; returns (stored file name, media type)
 def get_one_image(id:int,db:Session):
+    location = _image_locations.get(id)
+    if location:
+        return location
     image=db.query(DbImage).filter(DbImage.id==id).first()
     if not image:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                              detail=f'Image with id {id} not found')
  
-    path=f'uploaded_images/{image.image_name}'
-    return path
+    location = (image.image_name, image.image_type)
+    _image_locations.set(id, location)
+    return location
+ 
+#the stored file behind a cached location is gone; the next lookup reads the row again
+def forget_image_location(id:int):
+    _image_locations.pop(id)
  
  
 #show all images related to specific advertisement
@@ -83,6 +275,7 @@ def get_all_images(id:int,db:Session):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                              detail=f'Advertisement with id {id} not found')
     all_images =(db.query(DbImage)
+                 .options(joinedload(DbImage.blob))
                  .filter(DbImage.advertisement_id==id)
                  .order_by(DbImage.order_id.asc())
                  .all())
@@ -91,7 +284,7 @@ def get_all_images(id:int,db:Session):
                              detail=f'Images for advertisement with id {id} are not found')  
    
     for image in all_images:
-            image.image_path=f"http://127.0.0.1:8000/images/{image.image_name}"
+            _set_display_urls(image)
     return all_images
  
  
@@ -136,12 +329,13 @@ def change_image_order(image_id:int,new_order:int,db:Session,current_user_id:int
         db.refresh(repl_image)
  
     all_images =(db.query(DbImage)
+                 .options(joinedload(DbImage.blob))
                  .filter(DbImage.advertisement_id==advertisement.id)
                  .order_by(DbImage.order_id.asc())
                  .all())
    
     for image in all_images:
-            image.image_path=f"http://127.0.0.1:8000/images/{image.image_name}"
+            _set_display_urls(image)
  
     return all_images
  
@@ -161,13 +355,7 @@ def delete_image(image_id:int,db:Session,current_user_id:int):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='No permission to modify this advertisement')
    
-    image_path = image.image_path  
-    full_path = os.path.join(UPLOAD_DIR, os.path.basename(image_path))
-    if os.path.exists(full_path):
-        os.remove(full_path)
-    else:
-        print(f"File {full_path} not found, might already be deleted.")
- 
+    # the file goes once the delete is committed, see _release_blob
     db.delete(image)
     db.commit()
     return {"message": f"Image with id {image_id} has been deleted"}
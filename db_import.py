@@ -0,0 +1,180 @@
+import csv
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Dict, IO, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from db.database import SessionLocal
+from db.db_category import add_advertisement_counts, forget_category_summary
+from db.model import DbAdvertisement, DbCategory, StatusAdvertisementEnum
+from schemas import AdvertisementImportRow
+
+logger = logging.getLogger(__name__)
+
+# rows validated, inserted (one executemany) and committed together
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+# failed rows listed in the report; the count covers all of them
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+# the request body in an anonymous temp file, so the import reads it line by line from disk
+async def spool_import(chunks: AsyncIterator[bytes]) -> IO[bytes]:
+    spool = tempfile.TemporaryFile()
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > IMPORT_MAX_BYTES:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"Import is larger than {IMPORT_MAX_BYTES} bytes")
+            await run_in_threadpool(spool.write, chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+# a record that could not be read; its row is reported with the message and skipped
+class RowError(NamedTuple):
+    message: str
+
+
+# lines decoded with errors="surrogateescape" keep bytes that are not UTF-8 as lone surrogates
+def _undecodable(text: str) -> bool:
+    try:
+        text.encode("utf-8")
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+# (row number, fields) for every non-blank record; CSV takes a header line, NDJSON one JSON value per line.
+# Records that are not UTF-8 or not JSON come as a RowError instead of their fields, so one bad line
+# does not stop the import; the lines should be opened with errors="surrogateescape".
+def read_rows(lines: Iterable[str], format: str) -> Iterator[Tuple[int, Union[object, RowError]]]:
+    if format == "csv":
+        for number, record in enumerate(csv.DictReader(lines), start=1):
+            if any(_undecodable(value) for value in record.values() if isinstance(value, str)):
+                yield number, RowError("not valid UTF-8")
+                continue
+            # empty cells are missing values, so optional columns may be left blank
+            yield number, {key: value for key, value in record.items() if key and value not in ("", None)}
+        return
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        if _undecodable(line):
+            yield number, RowError("not valid UTF-8")
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as error:
+            yield number, RowError(f"invalid JSON: {error}")
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc'])) or 'row'}: {e['msg']}" for e in error.errors())
+
+
+def _batches(rows: Iterator, size: int) -> Iterator[list]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+
+    def fail(self, row: int, error: str):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": error})
+
+    def as_dict(self) -> dict:
+        return {"imported": self.imported, "failed": self.failed, "errors": self.errors}
+
+
+# insert advertisements owned by user_id from CSV or NDJSON lines, IMPORT_BATCH_SIZE rows per transaction.
+# Each batch checks its category ids in one query (ids seen before are remembered), inserts its valid rows
+# with one executemany and moves the category counters once per category. Bad rows are reported by number
+# and skipped; a batch the database rejects is reported row by row and the import goes on.
+def import_advertisements(lines: Iterable[str], format: str, user_id: int, batch_size: Optional[int] = None) -> dict:
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    report = ImportReport()
+    known_categories: Dict[int, bool] = {}
+    db = SessionLocal()
+    try:
+        for batch in _batches(read_rows(lines, format), batch_size):
+            valid = []
+            for number, fields in batch:
+                if isinstance(fields, RowError):
+                    report.fail(number, fields.message)
+                    continue
+                if not isinstance(fields, dict):
+                    report.fail(number, "expected a JSON object")
+                    continue
+                try:
+                    valid.append((number, AdvertisementImportRow.model_validate(fields)))
+                except ValidationError as error:
+                    report.fail(number, _describe(error))
+
+            unseen = {row.category_id for _, row in valid} - known_categories.keys()
+            if unseen:
+                found = set(db.scalars(select(DbCategory.id).where(DbCategory.id.in_(unseen))))
+                known_categories.update((category_id, category_id in found) for category_id in unseen)
+
+            now = datetime.utcnow()
+            values, counts = [], {}
+            for number, row in valid:
+                if not known_categories[row.category_id]:
+                    report.fail(number, f"Category with id {row.category_id} not found")
+                    continue
+                values.append({
+                    "title": row.title,
+                    "content": row.content,
+                    "price": row.price,
+                    "status": row.status,
+                    "created_at": row.created_at or now,
+                    "updated_at": now,
+                    "user_id": user_id,
+                    "category_id": row.category_id,
+                })
+                total, open_count = counts.get(row.category_id, (0, 0))
+                counts[row.category_id] = (total + 1, open_count + int(row.status == StatusAdvertisementEnum.OPEN))
+            if not values:
+                continue
+
+            try:
+                # render_nulls: rows with and without created_at stay one executemany
+                db.execute(insert(DbAdvertisement).execution_options(render_nulls=True), values)
+                add_advertisement_counts(db, counts)
+                db.commit()
+            except SQLAlchemyError as error:
+                db.rollback()
+                logger.exception("Could not import a batch of %d advertisements", len(values))
+                for number, row in valid:
+                    if known_categories[row.category_id]:
+                        report.fail(number, f"database error: {error.__class__.__name__}")
+                continue
+            report.imported += len(values)
+    finally:
+        db.close()
+        if report.imported:
+            forget_category_summary()
+    return report.as_dict()
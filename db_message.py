@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from db.database import SessionLocal
+from db.model import DbMessage
+from utils.pagination import DEFAULT_PAGE_SIZE, decode_cursor, encode_cursor, keyset_filter
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+# a batch the database cannot take is retried this many times, waiting up to MESSAGE_RETRY_MAX_DELAY
+# seconds between attempts, before it is given up and logged
+MESSAGE_RETRY_ATTEMPTS = int(os.getenv("MESSAGE_RETRY_ATTEMPTS", "8"))
+MESSAGE_RETRY_MAX_DELAY = float(os.getenv("MESSAGE_RETRY_MAX_DELAY", "5"))
+# how long a chat socket or a history request waits for queued messages to be written
+MESSAGE_FLUSH_TIMEOUT = float(os.getenv("MESSAGE_FLUSH_TIMEOUT", "2"))
+# how long close() keeps retrying what is still queued when the process stops
+MESSAGE_CLOSE_TIMEOUT = float(os.getenv("MESSAGE_CLOSE_TIMEOUT", "10"))
+# a socket can report a message sent before the sender's worker has written it; the report is tried
+# again for this many seconds, after which the message stays undelivered and is replayed on reconnect
+MESSAGE_MARK_TIMEOUT = float(os.getenv("MESSAGE_MARK_TIMEOUT", "30"))
+
+
+def new_message(advertisement_id: int, sender_id: int, receiver_id: int, content: str, delivered: bool) -> dict:
+    return {
+        "advertisement_id": advertisement_id,
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "participant_low": min(sender_id, receiver_id),
+        "participant_high": max(sender_id, receiver_id),
+        "content": content,
+        "created_at": datetime.utcnow(),
+        "delivered": delivered,
+    }
+
+
+def format_message(sender_id: int, advertisement_id: int, content: str) -> str:
+    return f"User {sender_id} (ad {advertisement_id}): {content}"
+
+
+# a message as its receiver's socket reports it sent, before the message has an id
+class DeliveryMark(NamedTuple):
+    advertisement_id: int
+    sender_id: int
+    receiver_id: int
+    created_at: datetime
+
+
+# what goes through the broker: the text for the receiver's socket and the mark it reports once sent
+def pack_message(row: dict) -> str:
+    return json.dumps({
+        "text": format_message(row["sender_id"], row["advertisement_id"], row["content"]),
+        "advertisement_id": row["advertisement_id"],
+        "sender_id": row["sender_id"],
+        "receiver_id": row["receiver_id"],
+        "created_at": row["created_at"].isoformat(),
+    })
+
+
+def unpack_message(payload: str) -> Tuple[str, DeliveryMark]:
+    data = json.loads(payload)
+    return data["text"], DeliveryMark(data["advertisement_id"], data["sender_id"], data["receiver_id"],
+                                      datetime.fromisoformat(data["created_at"]))
+
+
+# marks the messages delivered; returns the marks whose message is not in the database yet
+def apply_delivery_marks(marks: List[DeliveryMark]) -> List[DeliveryMark]:
+    db = SessionLocal()
+    try:
+        unmatched = []
+        for mark in marks:
+            matched = db.execute(update(DbMessage).where(
+                DbMessage.advertisement_id == mark.advertisement_id,
+                DbMessage.participant_low == min(mark.sender_id, mark.receiver_id),
+                DbMessage.participant_high == max(mark.sender_id, mark.receiver_id),
+                DbMessage.created_at == mark.created_at,
+                DbMessage.sender_id == mark.sender_id,
+            ).values(delivered=True)).rowcount
+            if not matched:
+                unmatched.append(mark)
+        db.commit()
+        return unmatched
+    finally:
+        db.close()
+
+
+def save_messages(rows: list):
+    db = SessionLocal()
+    try:
+        db.execute(insert(DbMessage), rows)
+        db.commit()
+    finally:
+        db.close()
+
+
+# chat messages are queued and written in batches by one task per worker, so a send costs a queue put
+# rather than a commit. Messages queued when the process stops are written by close().
+# Nothing is dropped when the database is briefly unavailable: the batch waits and is tried again.
+# Messages are stored undelivered; the receiver's socket reports each one it has sent with confirm(),
+# so a message it dropped or never got to send is replayed when the receiver connects again.
+class MessageWriter:
+    def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE, flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+                 max_queued: int = MESSAGE_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._unmatched: List[Tuple[DeliveryMark, float]] = []  # (mark, when it is given up)
+        self._task = asyncio.create_task(self._run())
+
+    # waits only when max_queued messages are already waiting for the database
+    async def write(self, message: dict):
+        await self._queue.put(message)
+
+    # the message was sent to its receiver's socket
+    async def confirm(self, mark: DeliveryMark):
+        await self._queue.put(mark)
+
+    # returns True once everything written so far is in the database, or False when that took longer
+    # than timeout (the database is down, say); the messages stay queued either way
+    async def flush(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("%d chat messages are still waiting for the database", self._queue.qsize())
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            try:  # marks waiting for their message are tried again every flush_interval
+                batch = [await asyncio.wait_for(self._queue.get(), self.flush_interval if self._unmatched else None)]
+            except asyncio.TimeoutError:
+                batch = []
+            deadline = self.loop.time() + self.flush_interval
+            while batch and len(batch) < self.batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            rows = [item for item in batch if not isinstance(item, DeliveryMark)]
+            try:
+                if rows:
+                    await self._save(rows)
+                await self._mark([item for item in batch if isinstance(item, DeliveryMark)])
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _mark(self, marks: List[DeliveryMark]):
+        now = self.loop.time()
+        pending = [(mark, expires) for mark, expires in self._unmatched if expires > now]
+        pending += [(mark, now + MESSAGE_MARK_TIMEOUT) for mark in marks]
+        if not pending:
+            self._unmatched = []
+            return
+        try:
+            unmatched = set(await run_in_threadpool(apply_delivery_marks, [mark for mark, _ in pending]))
+        except Exception:
+            logger.exception("Could not mark %d chat messages delivered", len(pending))
+            unmatched = {mark for mark, _ in pending}
+        self._unmatched = [(mark, expires) for mark, expires in pending if mark in unmatched]
+
+    # a failed batch is retried with a growing delay, MESSAGE_RETRY_ATTEMPTS times; a batch the database
+    # rejects (a message about a deleted advertisement, say) is split, so only the rejected rows are lost
+    async def _save(self, batch: list):
+        delay = self.flush_interval
+        for attempt in range(MESSAGE_RETRY_ATTEMPTS + 1):
+            try:
+                await run_in_threadpool(save_messages, batch)
+                return
+            except IntegrityError:
+                if len(batch) == 1:
+                    logger.exception("Dropping a chat message the database rejects")
+                    return
+                for message in batch:
+                    await self._save([message])
+                return
+            except Exception:
+                if attempt == MESSAGE_RETRY_ATTEMPTS:
+                    logger.exception("Gave up storing %d chat messages", len(batch))
+                    return
+                logger.exception("Could not store %d chat messages, retrying in %.2fs", len(batch), delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MESSAGE_RETRY_MAX_DELAY)
+
+    async def close(self):
+        if not await self.flush(MESSAGE_CLOSE_TIMEOUT):
+            logger.error("Gave up storing %d queued chat messages on shutdown", self._queue.qsize())
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+_writer: Optional[MessageWriter] = None
+
+
+# the writer of the running event loop, started on first use
+def get_message_writer() -> MessageWriter:
+    global _writer
+    if _writer is None or _writer.loop is not asyncio.get_running_loop():
+        _writer = MessageWriter()
+    return _writer
+
+
+async def close_message_writer():
+    global _writer
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+
+# messages that arrived while the user had no chat socket open, oldest first, as (id, text); created_at
+# before limits them to the ones that cannot come live any more. They stay undelivered until mark_delivered.
+def load_undelivered(receiver_id: int, before: Optional[datetime] = None) -> List[Tuple[int, str]]:
+    db = SessionLocal()
+    try:
+        query = db.query(DbMessage).filter(DbMessage.receiver_id == receiver_id, DbMessage.delivered.is_(False))
+        if before is not None:
+            query = query.filter(DbMessage.created_at < before)
+        messages = query.order_by(DbMessage.created_at.asc(), DbMessage.id.asc()).all()
+        return [(m.id, format_message(m.sender_id, m.advertisement_id, m.content)) for m in messages]
+    finally:
+        db.close()
+
+
+# called once the messages have been sent to the receiver's socket
+def mark_delivered(message_ids: List[int]):
+    db = SessionLocal()
+    try:
+        db.execute(update(DbMessage).where(DbMessage.id.in_(message_ids)).values(delivered=True))
+        db.commit()
+    finally:
+        db.close()
+
+
+# one page of the conversation between two users about an advertisement, newest first
+def get_conversation(db: Session, advertisement_id: int, user_id: int, other_user_id: int,
+                     cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE):
+    query = db.query(DbMessage).filter(
+        DbMessage.advertisement_id == advertisement_id,
+        DbMessage.participant_low == min(user_id, other_user_id),
+        DbMessage.participant_high == max(user_id, other_user_id),
+    )
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor, (datetime, int))
+        query = query.filter(keyset_filter(DbMessage.created_at, DbMessage.id, last_created_at, last_id))
+    messages = query.order_by(DbMessage.created_at.desc(), DbMessage.id.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = encode_cursor(messages[-1].created_at, messages[-1].id)
+    return {"items": messages, "next_cursor": next_cursor}
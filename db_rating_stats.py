@@ -0,0 +1,71 @@
+from sqlalchemy import case, delete, event, func, insert, select, update
+from sqlalchemy.orm import Session
+from db.model import DbRating, DbSellerRatingStats, DbTransaction
+
+
+_stats = DbSellerRatingStats.__table__
+
+
+# add one seller rating to the running totals; runs inside the caller's transaction (no commit).
+# A single upsert, so two first ratings for the same seller cannot both try to insert the row.
+def add_seller_rating(db: Session, seller_id: int, score: int):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        raise RuntimeError(f"Seller rating totals need INSERT ... ON CONFLICT, which {dialect} lacks")
+    db.execute(
+        dialect_insert(_stats)
+        .values(seller_id=seller_id, rating_count=1, rating_sum=score, average_rating=float(score))
+        .on_conflict_do_update(
+            index_elements=[_stats.c.seller_id],
+            set_={
+                "rating_count": _stats.c.rating_count + 1,
+                "rating_sum": _stats.c.rating_sum + score,
+                "average_rating": (_stats.c.rating_sum + score) * 1.0 / (_stats.c.rating_count + 1),
+            },
+        )
+    )
+
+
+# take a deleted rating back out of its seller's totals; ratings of buyers were never counted
+@event.listens_for(DbRating, "before_delete")
+def _remove_seller_rating(mapper, connection, target: DbRating):
+    seller_id = connection.scalar(select(DbTransaction.seller_id).where(DbTransaction.id == target.transaction_id))
+    if seller_id is None or seller_id != target.ratee_id:
+        return
+    remaining = _stats.c.rating_count - 1
+    connection.execute(
+        update(_stats)
+        .where(_stats.c.seller_id == seller_id)
+        .values(
+            rating_count=remaining,
+            rating_sum=_stats.c.rating_sum - target.score,
+            average_rating=case((remaining > 0, (_stats.c.rating_sum - target.score) * 1.0 / remaining), else_=0.0),
+        )
+    )
+
+
+# recompute every seller's totals from the full ratings history (backfills and repairs)
+def rebuild_seller_rating_stats(db: Session) -> int:
+    totals = (
+        select(
+            DbRating.ratee_id,
+            func.count(DbRating.id),
+            func.sum(DbRating.score),
+            func.avg(DbRating.score),
+        )
+        .join(DbTransaction, DbTransaction.id == DbRating.transaction_id)
+        .where(DbRating.ratee_id == DbTransaction.seller_id)
+        .group_by(DbRating.ratee_id)
+    )
+    db.execute(delete(DbSellerRatingStats))
+    db.execute(
+        insert(DbSellerRatingStats).from_select(
+            ["seller_id", "rating_count", "rating_sum", "average_rating"], totals
+        )
+    )
+    db.commit()
+    return db.query(func.count(DbSellerRatingStats.seller_id)).scalar()
@@ -0,0 +1,110 @@
+import re
+import weakref
+from typing import Optional
+from sqlalchemy import Float, Integer, column, inspect, text
+from sqlalchemy.engine import Engine
+
+# FTS5 index over advertisement title/content. It is an external-content table,
+# so the text itself lives only in `advertisement`; the triggers below keep the
+# index in sync with every insert, edit and delete done through SQLite.
+FTS_TABLE = "advertisement_fts"
+
+_CREATE_FTS_TABLE = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    title,
+    content,
+    content='advertisement',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+)
+"""
+
+_CREATE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON advertisement BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON advertisement BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF title, content ON advertisement BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END
+    """,
+]
+
+# title matches weigh more than content matches in the bm25 score
+TITLE_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+
+
+def is_supported(bind) -> bool:
+    return bind.dialect.name == "sqlite"
+
+
+# engines whose index is known to exist; one made with create_all() alone has none until
+# `python manage.py migrate` creates it, and searches there fall back to LIKE
+_indexed_engines = weakref.WeakSet()
+
+
+def has_search_index(bind) -> bool:
+    if not is_supported(bind):
+        return False
+    engine = getattr(bind, "engine", bind)
+    if engine not in _indexed_engines:
+        with engine.connect() as conn:
+            if not inspect(conn).has_table(FTS_TABLE):
+                return False
+        _indexed_engines.add(engine)
+    return True
+
+
+# create the index and its triggers if missing, filling it from existing ads the first time
+def ensure_search_index(engine: Engine):
+    if not is_supported(engine):
+        return
+    with engine.begin() as conn:
+        exists = inspect(conn).has_table(FTS_TABLE)
+        conn.execute(text(_CREATE_FTS_TABLE))
+        for trigger in _CREATE_TRIGGERS:
+            conn.execute(text(trigger))
+        if not exists:
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    _indexed_engines.add(engine)
+
+
+# rebuild the whole index from the advertisement table (after bulk changes done with triggers off)
+def rebuild_search_index(engine: Engine):
+    if not is_supported(engine):
+        return
+    ensure_search_index(engine)
+    with engine.begin() as conn:
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+# turn free text into an FTS5 query: every word must match, each one as a prefix
+def build_match_query(keyword: str) -> Optional[str]:
+    terms = re.findall(r"\w+", keyword)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+# subquery with (advertisement_id, rank) of the ads matching the keyword; lower rank is a better match
+def match_subquery(match_query: str):
+    return (
+        text(
+            f"SELECT rowid AS advertisement_id, "
+            f"bm25({FTS_TABLE}, {TITLE_WEIGHT}, {CONTENT_WEIGHT}) AS rank "
+            f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match_query"
+        )
+        .bindparams(match_query=match_query)
+        .columns(column("advertisement_id", Integer), column("rank", Float))
+        .subquery("advertisement_match")
+    )
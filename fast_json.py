@@ -0,0 +1,33 @@
+import json
+import os
+from datetime import date, datetime
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # falls back to the standard library encoder
+    orjson = None
+
+# build listing pages straight from column tuples and encode them here, skipping ORM objects and
+# response_model validation; the JSON is the same either way
+FAST_JSON_LISTINGS = os.getenv("FAST_JSON_LISTINGS", "off").lower() in ("1", "true", "yes", "on")
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# for content that is already plain dicts, lists and scalars; nothing is validated
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+
+# uploads are stored as <sha256>.<ext> (or, before that, <name>_<uuid4 hex>.<ext>) and resized
+# variants add a _<variant> suffix; none of these names is ever reused for different bytes
+_IMMUTABLE_NAME = re.compile(r"(^[0-9a-f]{64}|_[0-9a-f]{32})(_[a-z]+)?\.\w+$")
+_CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{64}(_[a-z]+)?$")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+# urls keyed by something other than the content (show_image/{id}) can start pointing elsewhere or
+# at nothing when the image is deleted, so they are only cached briefly and then revalidated
+REVALIDATE_CACHE_CONTROL = f"public, max-age={int(os.getenv('SHOW_IMAGE_MAX_AGE', '60'))}, must-revalidate"
+CHUNK_SIZE = 64 * 1024
+
+
+def is_immutable(file_name: str) -> bool:
+    return bool(_IMMUTABLE_NAME.search(file_name))
+
+
+# strong ETag: the content hash when the name carries one, otherwise derived from mtime and size
+def etag_for(path: str, stat_result: os.stat_result) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _CONTENT_ADDRESSED_NAME.match(stem):
+        return f'"{stem}"'
+    return '"' + hashlib.md5(f"{stat_result.st_mtime}-{stat_result.st_size}".encode()).hexdigest() + '"'
+
+
+def _not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+# the single byte range asked for, as (start, end) inclusive; None means send the whole file
+def _requested_range(request: Request, etag: str, size: int) -> Optional[tuple]:
+    range_header = request.headers.get("range")
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:  # bytes=-500: the last 500 bytes
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(range_header)
+    return start, end
+
+
+def _iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# serve a stored image with validators and cache headers, answering conditional requests
+# with 304 and byte ranges with 206; cache_control replaces the header picked from the file name.
+# A file that is not there (deleted since its path was looked up) is a 404
+def file_response(request: Request, path: str, media_type: Optional[str] = None,
+                  stat_result: Optional[os.stat_result] = None, status_code: int = 200,
+                  cache_control: Optional[str] = None) -> Response:
+    if stat_result is None:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
+    etag = etag_for(path, stat_result)
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": cache_control or (IMMUTABLE_CACHE_CONTROL if is_immutable(os.path.basename(path)) else DEFAULT_CACHE_CONTROL),
+        "accept-ranges": "bytes",
+    }
+    if _not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    size = stat_result.st_size
+    try:
+        byte_range = _requested_range(request, etag, size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "content-range": f"bytes */{size}"})
+    if byte_range:
+        start, end = byte_range
+        headers.update({"content-range": f"bytes {start}-{end}/{size}", "content-length": str(end - start + 1)})
+        return StreamingResponse(_iter_file_range(path, start, end), status_code=206,
+                                 headers=headers, media_type=media_type)
+
+    return FileResponse(path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result)
+
+
+# the /images mount, with the same caching and range handling as the show_image route
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200) -> Response:
+        return file_response(Request(scope), str(full_path), stat_result=stat_result, status_code=status_code)
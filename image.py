@@ -1,12 +1,15 @@
+import os
 from typing import List
-from fastapi import APIRouter, Depends, File, Request, UploadFile
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import FileResponse, RedirectResponse
 from router.auth import get_current_user
 from db import db_image
-from db.database import get_db
-from sqlalchemy.orm.session import Session
-from schemas import  ImageAllDisplay, ImageOneDisplay,ImageAllChangeDisplay
+from db.database import get_async_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils import http_cache
+from utils.storage import get_storage
+from utils.uploads import check_content_length, iter_upload_file, read_image_form
+from schemas import  ImageAllDisplay, ImageOneDisplay,ImageAllChangeDisplay,ImageUploadConfirm,ImageUploadRequest,ImageUploadTicket
 
 router = APIRouter(
     prefix='/advertisements',
@@ -14,27 +17,64 @@ router = APIRouter(
 )
 
 
-# add images to advertisement
-@router.post('/{advertisement_id}/add_images',response_model=ImageOneDisplay)
-def add_image(advertisement_id:int,image: UploadFile = File(),db:Session=Depends(get_db), user_id: int = Depends(get_current_user)):
-    return  db_image.add_image(advertisement_id,image,db,user_id)
+# add images to advertisement (multipart form upload, the file in the 'image' field); the size limit
+# applies while the form is read
+IMAGE_FORM = {"requestBody": {"required": True, "content": {"multipart/form-data": {"schema": {
+    "type": "object", "required": ["image"], "properties": {"image": {"type": "string", "format": "binary"}}}}}}}
 
-#show one image  related to advertisement
+@router.post('/{advertisement_id}/add_images',response_model=ImageOneDisplay,openapi_extra=IMAGE_FORM)
+async def add_image(advertisement_id:int,request:Request,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    image = await read_image_form(request)
+    try:
+        return await db_image.add_image(advertisement_id,image.filename,image.content_type,iter_upload_file(image),db,user_id)
+    finally:
+        await image.close()
+
+# add images to advertisement with the raw image as the request body; the body is streamed to disk
+# as it arrives and rejected as soon as it is too large or not an image
+@router.put('/{advertisement_id}/upload_image',response_model=ImageOneDisplay)
+async def upload_image(advertisement_id:int,filename:str,request:Request,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    check_content_length(request.headers.get("content-length"))
+    return await db_image.add_image(advertisement_id,filename,request.headers.get("content-type"),request.stream(),db,user_id)
+
+# direct upload, step one: a pre-signed url the client sends the image to, bypassing the API
+@router.post('/{advertisement_id}/image_upload_url',response_model=ImageUploadTicket)
+async def request_image_upload(advertisement_id:int,upload:ImageUploadRequest,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    return await db.run_sync(lambda session: db_image.request_image_upload(advertisement_id,upload,session,user_id))
+
+# direct upload, step two: record the image once its bytes are in storage
+@router.post('/{advertisement_id}/confirm_image_upload',response_model=ImageOneDisplay)
+async def confirm_image_upload(advertisement_id:int,confirmation:ImageUploadConfirm,db:AsyncSession=Depends(get_async_db), user_id: int = Depends(get_current_user)):
+    return await db_image.confirm_image_upload(advertisement_id,confirmation,db,user_id)
+
+#show one image  related to advertisement, with ETag/Last-Modified validators and Range support;
+#the id can stop pointing at this file, so it is cached briefly and revalidated rather than kept
+#like /images/<name>. Images kept in a bucket are a redirect to their public url
 @router.get('/show_image/{image_id}',response_class=FileResponse)
-def get_one_image(image_id:int,db:Session=Depends(get_db)):
-    return db_image.get_one_image(image_id,db)
+async def get_one_image(image_id:int,request:Request,db:AsyncSession=Depends(get_async_db)):
+    image_name, media_type = await db.run_sync(lambda session: db_image.get_one_image(image_id,session))
+    storage = get_storage()
+    path = storage.local_path(image_name)
+    if path is None:
+        return RedirectResponse(storage.public_url(image_name))
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        db_image.forget_image_location(image_id)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Image with id {image_id} not found')
+    return http_cache.file_response(request, path, media_type, stat_result=stat_result, cache_control=http_cache.REVALIDATE_CACHE_CONTROL)
 
 #show all images related to advertisement
 @router.get('/{advertisement_id}/show_all_images',response_model=List[ImageAllDisplay])
-def get_all_images(advertisement_id:int,db:Session=Depends(get_db)):
-    return db_image.get_all_images(advertisement_id,db)
+async def get_all_images(advertisement_id:int,db:AsyncSession=Depends(get_async_db)):
+    return await db.run_sync(lambda session: db_image.get_all_images(advertisement_id,session))
 
 #changing order of images related to advertisement
 @router.patch('/change_image_order/{image_id}',response_model=List[ImageAllChangeDisplay])
-def change_image_order(image_id:int,new_order:int,db:Session=Depends(get_db),user_id:int=Depends(get_current_user)):
-    return db_image.change_image_order(image_id,new_order,db,user_id)
+async def change_image_order(image_id:int,new_order:int,db:AsyncSession=Depends(get_async_db),user_id:int=Depends(get_current_user)):
+    return await db.run_sync(lambda session: db_image.change_image_order(image_id,new_order,session,user_id))
 
 #delete one image related to advertisement
 @router.delete('/delete_image/{image_id}')
-def delete_image(image_id:int,db:Session=Depends(get_db),user_id:int=Depends(get_current_user)):
-    return db_image.delete_image(image_id,db,user_id)
\ No newline at end of file
+async def delete_image(image_id:int,db:AsyncSession=Depends(get_async_db),user_id:int=Depends(get_current_user)):
+    return await db.run_sync(lambda session: db_image.delete_image(image_id,session,user_id))
\ No newline at end of file
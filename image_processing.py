@@ -0,0 +1,105 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from db.database import SessionLocal
+from db.model import DbImageBlob
+from utils.storage import get_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: without it only the original upload is served
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# variant name -> (bounding box, output format or None to keep the upload's format)
+VARIANTS = {
+    "thumbnail": ((200, 200), None),
+    "medium": ((800, 800), None),
+    "webp": ((800, 800), "WEBP"),
+}
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# resizing is CPU-bound but Pillow releases the GIL while it works, so threads are enough;
+# the pool size caps how much CPU uploads can take away from request handling
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-variants")
+
+
+def variant_name(image_name: str, variant: str) -> str:
+    stem, ext = os.path.splitext(image_name)
+    _, output_format = VARIANTS[variant]
+    if output_format == "WEBP":
+        return f"{stem}_{variant}.webp"
+    return f"{stem}_{variant}{ext}"
+
+
+# write every variant next to the original and return the names of the ones created
+def generate_variants(image_path: str, image_name: str) -> list:
+    if Image is None:
+        return []
+    directory = os.path.dirname(image_path)
+    created = []
+    with Image.open(image_path) as original:
+        source_format = original.format  # exif_transpose returns a copy without it
+        original = ImageOps.exif_transpose(original)  # phone photos store rotation in EXIF
+        for variant, (size, output_format) in VARIANTS.items():
+            resized = original.copy()
+            resized.thumbnail(size)
+            output_format = output_format or source_format or "PNG"
+            if output_format == "JPEG" and resized.mode not in ("RGB", "L"):
+                resized = resized.convert("RGB")
+            resized.save(os.path.join(directory, variant_name(image_name, variant)), format=output_format)
+            created.append(variant)
+    return created
+
+
+def _process(sha256: str, image_name: str):
+    storage = get_storage()
+    try:
+        with storage.local_copy(image_name) as image_path:
+            variants = generate_variants(image_path, image_name)
+            for variant in variants:
+                name = variant_name(image_name, variant)
+                storage.save(os.path.join(os.path.dirname(image_path), name), name)
+    except Exception:
+        logger.exception("Could not create variants of image blob %s", sha256)
+        return
+    if not variants:
+        return
+    db = SessionLocal()
+    try:
+        db.query(DbImageBlob).filter(DbImageBlob.sha256 == sha256).update({DbImageBlob.variants: ",".join(variants)})
+        db.commit()
+    finally:
+        db.close()
+
+
+# queue variant generation for a newly stored blob; the request returns without waiting for it
+def submit_variants(sha256: str, image_name: str):
+    if Image is not None:
+        _executor.submit(_process, sha256, image_name)
+
+
+# delete a stored image and its variants, unless an upload of the same content has created
+# a blob for the file again since it was released
+def remove_image_files(image_name: str):
+    db = SessionLocal()
+    try:
+        if db.query(DbImageBlob.sha256).filter(DbImageBlob.file_name == image_name).first():
+            return
+    finally:
+        db.close()
+    storage = get_storage()
+    storage.delete(image_name)
+    for variant in VARIANTS:
+        storage.delete(variant_name(image_name, variant))
+
+
+# removal queries the database and deletes files (network round trips with a bucket), and is called
+# from after_commit hooks that can run on the event loop, so it always goes to the worker pool
+def submit_removal(image_name: str):
+    _executor.submit(remove_image_files, image_name)
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
@@ -1,20 +1,45 @@
+from contextlib import asynccontextmanager
+import os
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from utils.http_cache import CachedStaticFiles
 from db import model
-from db.database import engine, Base
+from db import migrations
+from db.database import DB_AUTO_MIGRATE, async_engine, engine
 from fastapi.responses import HTMLResponse
 from router import advertisement, category,image,chat
 from router.rating import router as rating_router   
 from router.auth import router as auth_router
 from router import chat
 from router import transactions
+from db.db_message import close_message_writer
+from utils import image_processing, security
+from utils.broker import close_broker
+from utils.response_cache import ResponseCacheMiddleware
+from utils.revocation import close_revocation_store
+from utils.storage import UPLOAD_DIR
 
-app = FastAPI()
-app.mount("/images", StaticFiles(directory="uploaded_images"), name="images")
-UPLOAD_DIR = "uploaded_images"
+
+# nothing touches the database at import time; the schema is created by `python manage.py migrate`
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    if DB_AUTO_MIGRATE:
+        await run_in_threadpool(migrations.upgrade, engine)
+    yield
+    await close_broker()
+    await close_revocation_store()
+    await close_message_writer()
+    await run_in_threadpool(image_processing.shutdown)
+    await async_engine.dispose()
+    engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ResponseCacheMiddleware)
+app.mount("/images", CachedStaticFiles(directory=UPLOAD_DIR, check_dir=False), name="images")
 
 app.include_router(auth_router, prefix="/auth", tags=["Authentication"])
-Base.metadata.create_all(bind=engine)  # Create tables on startup
 
 app.include_router(auth_router, prefix="/auth", tags=["Registration"])
 app.include_router(category.router)
@@ -24,3 +49,9 @@ app.include_router(chat.router)
 app.include_router(rating_router)
 app.include_router(transactions.router)
 
+
+# liveness for load balancers and monitoring, with the password hashing pool's load: how many hashes are
+# running and queued, and how many logins/registrations were turned away with 503
+@app.get("/health", tags=["Health"])
+async def health():
+    return {"status": "ok", "password_hashing": security.password_hash_stats()}
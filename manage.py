@@ -0,0 +1,118 @@
+import argparse
+import sys
+from datetime import datetime
+from db.database import Base, SessionLocal, engine
+from db import model
+from db.db_category import rebuild_category_counts
+from db.db_rating_stats import rebuild_seller_rating_stats
+from db import db_search, migrations
+from db.db_export import export_advertisements, gzip_stream
+from db.db_import import import_advertisements
+
+
+# python manage.py migrate
+def migrate(args):
+    changes = migrations.upgrade(engine)
+    for change in changes:
+        print(f"Created {change}")
+    print("Database is up to date")
+
+
+# python manage.py rebuild-rating-stats
+def rebuild_rating_stats(args):
+    Base.metadata.create_all(bind=engine)
+    db_search.ensure_search_index(engine)
+    db = SessionLocal()
+    try:
+        sellers = rebuild_seller_rating_stats(db)
+    finally:
+        db.close()
+    print(f"Rebuilt rating stats for {sellers} sellers")
+
+
+# python manage.py rebuild-category-counts
+def rebuild_category_counters(args):
+    Base.metadata.create_all(bind=engine)
+    db_search.ensure_search_index(engine)
+    db = SessionLocal()
+    try:
+        categories = rebuild_category_counts(db)
+    finally:
+        db.close()
+    print(f"Rebuilt advertisement counts for {categories} categories")
+
+
+# python manage.py export --output ads.ndjson.gz --gzip [--since 2025-06-01T00:00:00]
+def export(args):
+    chunks = export_advertisements(args.since, args.since_field)
+    if args.gzip:
+        chunks = gzip_stream(chunks)
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+# python manage.py import --user-id 7 listings.csv   (or --format ndjson)
+def import_file(args):
+    Base.metadata.create_all(bind=engine)
+    db_search.ensure_search_index(engine)
+    format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    with open(args.file, encoding="utf-8-sig", errors="surrogateescape", newline="") as lines:
+        report = import_advertisements(lines, format, args.user_id, args.batch_size)
+    for error in report["errors"]:
+        print(f"row {error['row']}: {error['error']}", file=sys.stderr)
+    print(f"Imported {report['imported']} advertisements, skipped {report['failed']} rows")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Marketplace maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upgrade = commands.add_parser(
+        "migrate",
+        help="create missing tables and indexes in an existing database",
+    )
+    upgrade.set_defaults(func=migrate)
+
+    rebuild = commands.add_parser(
+        "rebuild-rating-stats",
+        help="recompute the per-seller rating totals from all ratings",
+    )
+    rebuild.set_defaults(func=rebuild_rating_stats)
+
+    counts = commands.add_parser(
+        "rebuild-category-counts",
+        help="recompute the per-category advertisement counts from all advertisements",
+    )
+    counts.set_defaults(func=rebuild_category_counters)
+
+    dump = commands.add_parser(
+        "export",
+        help="write advertisements as NDJSON, streamed from the database in batches",
+    )
+    dump.add_argument("--output", default="-", help="file to write, - for stdout")
+    dump.add_argument("--gzip", action="store_true", help="gzip the output")
+    dump.add_argument("--since", type=datetime.fromisoformat, help="only ads created/updated after this time")
+    dump.add_argument("--since-field", choices=["updated_at", "created_at"], default="updated_at")
+    dump.set_defaults(func=export)
+
+    load = commands.add_parser(
+        "import",
+        help="insert advertisements from a CSV or NDJSON file in batches",
+    )
+    load.add_argument("file")
+    load.add_argument("--user-id", type=int, required=True, help="owner of the imported advertisements")
+    load.add_argument("--format", choices=["csv", "ndjson"], help="default: from the file extension")
+    load.add_argument("--batch-size", type=int, help="rows per transaction (default: IMPORT_BATCH_SIZE)")
+    load.set_defaults(func=import_file)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
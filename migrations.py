@@ -0,0 +1,96 @@
+import logging
+from sqlalchemy import delete, func, inspect, select, text
+from sqlalchemy.engine import Engine
+from db.database import Base, SessionLocal
+from db import model
+from db.model import DbRating
+from db import db_search
+from db.db_category import rebuild_category_counts
+from db.db_rating_stats import rebuild_seller_rating_stats
+
+logger = logging.getLogger(__name__)
+
+
+# bring an existing database up to the current models; safe to run any number of times
+def upgrade(engine: Engine) -> list:
+    changes = []
+    existing_tables = set(inspect(engine).get_table_names())
+
+    Base.metadata.create_all(bind=engine)
+    changes += [f"table {name}" for name in Base.metadata.tables if name not in existing_tables]
+    added_columns = add_missing_columns(engine)
+    changes += [f"column {name}" for name in added_columns]
+    removed_ratings = remove_duplicate_ratings(engine)
+    changes += [f"index {name}" for name in create_missing_indexes(engine)]
+    db_search.ensure_search_index(engine)
+
+    # backfill tables that are derived from existing rows
+    if removed_ratings or ("seller_rating_stats" not in existing_tables and "ratings" in existing_tables):
+        db = SessionLocal(bind=engine)
+        try:
+            rebuild_seller_rating_stats(db)
+        finally:
+            db.close()
+    if "advertisement.updated_at" in added_columns:
+        with engine.begin() as conn:
+            conn.execute(text('UPDATE advertisement SET updated_at = created_at WHERE updated_at IS NULL'))
+    if "category.advertisement_count" in added_columns:
+        db = SessionLocal(bind=engine)
+        try:
+            rebuild_category_counts(db)
+        finally:
+            db.close()
+
+    if changes and engine.dialect.name == "sqlite":
+        # refresh the planner statistics so the new indexes get picked up
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+    return changes
+
+
+# columns added to a model after its table was created; only nullable columns can be added this way
+def add_missing_columns(engine: Engine) -> list:
+    added = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} to an existing table")
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+
+# the unique index on ratings(transaction_id, rater_id) cannot be created over ratings given twice
+# before it existed; the latest of each is kept and the ids of the others are logged
+def remove_duplicate_ratings(engine: Engine) -> int:
+    ratings = DbRating.__table__
+    with engine.begin() as conn:
+        if any(index["name"] == "ux_ratings_transaction_id_rater_id" for index in inspect(conn).get_indexes("ratings")):
+            return 0
+        latest = select(func.max(ratings.c.id)).group_by(ratings.c.transaction_id, ratings.c.rater_id)
+        duplicates = conn.execute(select(ratings.c.id).where(ratings.c.id.not_in(latest))).scalars().all()
+        if duplicates:
+            conn.execute(delete(ratings).where(ratings.c.id.in_(duplicates)))
+            logger.warning("Removed %d ratings given twice for the same transaction by the same user, "
+                           "keeping the latest of each: ids %s", len(duplicates), duplicates)
+    return len(duplicates)
+
+
+# create_all() skips tables that already exist, including their indexes, so add those one by one
+def create_missing_indexes(engine: Engine) -> list:
+    created = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    created.append(index.name)
+    return created
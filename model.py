@@ -1,5 +1,5 @@
 from db.database import Base
-from sqlalchemy import Column, Integer, LargeBinary, String, Boolean, Float, ForeignKey, Enum, DateTime, Text
+from sqlalchemy import Column, Integer, LargeBinary, String, Boolean, Float, ForeignKey, Enum, DateTime, Text, Index
 from sqlalchemy.orm import relationship
 import enum
 from sqlalchemy import Enum as SqlEnum
@@ -28,6 +28,7 @@ class DbUser (Base):
     received_ratings = relationship("DbRating", foreign_keys="DbRating.ratee_id", back_populates="ratee", cascade="all, delete-orphan")
     purchases        = relationship("DbTransaction", foreign_keys="DbTransaction.buyer_id", back_populates="buyer", cascade="all, delete-orphan")
     sales            = relationship("DbTransaction", foreign_keys="DbTransaction.seller_id", back_populates="seller", cascade="all, delete-orphan")
+    seller_rating_stats = relationship("DbSellerRatingStats", back_populates="seller", uselist=False, cascade="all, delete-orphan")
     
 # advertisement table
 class DbAdvertisement(Base):
@@ -37,13 +38,22 @@ class DbAdvertisement(Base):
     content = Column(String)
     price = Column(Float, nullable=False)
     status = Column(SqlEnum(StatusAdvertisementEnum), nullable=False, default=StatusAdvertisementEnum.OPEN)
-    created_at= Column(DateTime, default=datetime.utcnow)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    created_at= Column(DateTime, default=datetime.utcnow, index=True)
+    # set on every ORM write; lets exports pick up only what changed. Nullable so the migration can add it.
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     category_id = Column(Integer, ForeignKey('category.id'))
     user = relationship('DbUser', back_populates='advertisements')
     category = relationship('DbCategory', back_populates='advertisements')
     images = relationship('DbImage', back_populates='advertisement',order_by='DbImage.order_id.asc()', cascade="all, delete-orphan")
     transactions  = relationship("DbTransaction",  foreign_keys="DbTransaction.advertisement_id" , back_populates="advertisement", cascade="all, delete-orphan")
+    messages = relationship("DbMessage", back_populates="advertisement", cascade="all, delete-orphan")
+    # listings page newest first, optionally within a category or status.
+    # SQLite appends the id (rowid) to every index, which covers the (created_at, id) keyset.
+    __table_args__ = (
+        Index("ix_advertisement_category_id_created_at", category_id, created_at.desc()),
+        Index("ix_advertisement_status_created_at", status, created_at),
+    )
 
 
 #category table
@@ -51,6 +61,10 @@ class DbCategory(Base):
     __tablename__ = 'category'
     id = Column(Integer, primary_key=True, index=True)  
     title = Column(String,nullable=False)  
+    # maintained on every advertisement write (db_category.move_advertisement_count);
+    # nullable only so the migration can add them to an existing table
+    advertisement_count = Column(Integer, default=0)
+    open_advertisement_count = Column(Integer, default=0)
     advertisements = relationship('DbAdvertisement', back_populates='category')
 
 # images for adv -  table
@@ -62,17 +76,33 @@ class DbImage(Base):
     image_name = Column(String, nullable=False) 
     image_path = Column(String, nullable=False)  
     image_type=Column(String)
+    variants=Column(String)  # resized variants of images without a blob; see DbImageBlob.variants
     advertisement_id = Column(Integer, ForeignKey("advertisement.id"))
+    # shared file holding the bytes; images uploaded before content addressing have none
+    blob_sha256 = Column(String, ForeignKey("image_blob.sha256"), index=True)
     advertisement = relationship('DbAdvertisement', back_populates='images')
+    blob = relationship('DbImageBlob')
+    __table_args__ = (
+        Index("ix_image_advertisement_id_order_id", advertisement_id, order_id),
+    )
+# one stored file per distinct image content, shared by every DbImage with the same bytes
+class DbImageBlob(Base):
+    __tablename__ = 'image_blob'
+    sha256 = Column(String, primary_key=True)
+    file_name = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    variants = Column(String)  # comma-separated resized variants that are ready
+    ref_count = Column(Integer, nullable=False, default=0)
+
 #Tina Sprint2 beginning
 class DbTransaction(Base):
     __tablename__ = "transactions"
     id = Column(Integer, primary_key=True) #remove default=lambda: str(uuid.uuid4()) to avoid type mismatch.
-    buyer_id = Column(Integer, ForeignKey("user.id"), nullable=False)
-    seller_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    buyer_id = Column(Integer, ForeignKey("user.id"), nullable=False, index=True)
+    seller_id = Column(Integer, ForeignKey("user.id"), nullable=False, index=True)
     completed = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    advertisement_id = Column(Integer, ForeignKey("advertisement.id"), nullable=False)
+    advertisement_id = Column(Integer, ForeignKey("advertisement.id"), nullable=False, index=True)
 
     buyer         = relationship("DbUser",  foreign_keys=[buyer_id],         back_populates="purchases")
     seller        = relationship("DbUser", foreign_keys=[seller_id],        back_populates="sales")
@@ -84,7 +114,7 @@ class DbRating(Base):
     id = Column(Integer, primary_key=True) #remove default=lambda: str(uuid.uuid4()) to avoid type mismatch.
     transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=False)
     rater_id = Column(Integer, ForeignKey("user.id"), nullable=False)
-    ratee_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    ratee_id = Column(Integer, ForeignKey("user.id"), nullable=False, index=True)
     score = Column(Integer, nullable=False)
     
     #define score type based on seller and buyer ratings
@@ -93,6 +123,38 @@ class DbRating(Base):
     rater = relationship("DbUser", foreign_keys=[rater_id], back_populates="given_ratings")
     ratee = relationship("DbUser", foreign_keys=[ratee_id], back_populates="received_ratings")
     transaction   = relationship("DbTransaction", foreign_keys=[transaction_id] , back_populates="ratings")
+    # one rating per user per transaction; also serves lookups by transaction_id
+    __table_args__ = (
+        Index("ux_ratings_transaction_id_rater_id", transaction_id, rater_id, unique=True),
+    )
 
 # Tina Sprint2 end
 
+# running totals of the ratings each user received as a seller, kept up to date by crud.create_rating
+class DbSellerRatingStats(Base):
+    __tablename__ = "seller_rating_stats"
+    seller_id = Column(Integer, ForeignKey("user.id"), primary_key=True)
+    rating_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    average_rating = Column(Float, nullable=False, default=0)
+    seller = relationship("DbUser", back_populates="seller_rating_stats")
+
+# chat messages. A conversation is two users talking about one advertisement; its participants are
+# stored lower id first, so both directions of the conversation are read from one index range
+class DbMessage(Base):
+    __tablename__ = "message"
+    id = Column(Integer, primary_key=True)
+    advertisement_id = Column(Integer, ForeignKey("advertisement.id"), nullable=False)
+    sender_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    receiver_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    participant_low = Column(Integer, nullable=False)
+    participant_high = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # False while the receiver had no open chat socket; sent to them when they reconnect
+    delivered = Column(Boolean, nullable=False, default=False)
+    advertisement = relationship("DbAdvertisement", back_populates="messages")
+    __table_args__ = (
+        Index("ix_message_conversation", advertisement_id, participant_low, participant_high, created_at),
+        Index("ix_message_receiver_id_delivered", receiver_id, delivered),
+    )
@@ -0,0 +1,36 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from sqlalchemy import or_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+# cursors are the sort key of the last row sent, as url-safe base64 json; clients treat them as opaque
+def encode_cursor(*values) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, types: tuple) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(cursor)
+        return [
+            datetime.fromisoformat(v) if t is datetime else t(v)
+            for v, t in zip(values, types)
+        ]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+# rows strictly after (last_key, last_id) when ordering by sort_key, then id descending.
+# The leading range condition on sort_key lets the database seek the index instead of skipping rows.
+def keyset_filter(sort_key, id_column, last_key, last_id, descending: bool = True):
+    if descending:
+        return (sort_key <= last_key) & or_(sort_key < last_key, id_column < last_id)
+    return (sort_key >= last_key) & or_(sort_key > last_key, id_column < last_id)
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import math
+import os
+import re
+import threading
+from typing import Iterable, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from utils.cache import TTLCache
+
+try:
+    import redis
+except ImportError:  # redis is only needed when RESPONSE_CACHE_URL is set
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "on").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", str(256 * 1024)))
+# redis://host:6379/0 to share cached responses and table versions between workers and nodes;
+# unset keeps both in this process, where writes made by other workers show after the ttl
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+
+
+# a cacheable route: the path it matches, how long its responses live and the tables they are read from
+class CachePolicy(NamedTuple):
+    path: re.Pattern
+    ttl: float
+    tables: Tuple[str, ...]
+
+
+_LISTING_TABLES = ("advertisement", "user", "category", "seller_rating_stats")
+POLICIES = (
+    CachePolicy(re.compile(r"^/advertisements/all$"), RESPONSE_CACHE_TTL, _LISTING_TABLES),
+    CachePolicy(re.compile(r"^/advertisements/search$"), RESPONSE_CACHE_TTL, _LISTING_TABLES),
+    CachePolicy(re.compile(r"^/advertisements/\d+$"), RESPONSE_CACHE_TTL * 2, ("advertisement", "user", "category", "image")),
+    CachePolicy(re.compile(r"^/advertisements/\d+/show_all_images$"), RESPONSE_CACHE_TTL * 2, ("advertisement", "image", "image_blob")),
+)
+_WATCHED_TABLES = frozenset(table for policy in POLICIES for table in policy.tables)
+
+
+def find_policy(path: str) -> Optional[CachePolicy]:
+    for policy in POLICIES:
+        if policy.path.match(path):
+            return policy
+    return None
+
+
+# the same parameters in any order, or with empty values, are the same request
+def normalize_query(query_string: bytes) -> str:
+    return urlencode(sorted(parse_qsl(query_string.decode("latin-1"))))
+
+
+def _encode(content_type: bytes, body: bytes) -> bytes:
+    return content_type + b"\n" + body
+
+
+def _decode(entry: bytes) -> Tuple[bytes, bytes]:
+    content_type, _, body = entry.partition(b"\n")
+    return content_type, body
+
+
+class InMemoryResponseCache:
+    blocking = False
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        self._entries = TTLCache(maxsize)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._entries.get(key)
+
+    def set(self, key: str, entry: bytes, ttl: float):
+        self._entries.set(key, entry, ttl)
+
+    def versions(self, tables: Iterable[str]) -> tuple:
+        return tuple(self._versions.get(table, 0) for table in tables)
+
+    def bump(self, tables: Iterable[str]):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+# entries and table versions in Redis, so a write on any node invalidates every node's responses at once
+class RedisResponseCache:
+    blocking = True  # called from the threadpool
+    prefix = "response-cache:"
+
+    def __init__(self, url: Optional[str] = None, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError("RESPONSE_CACHE_URL needs the redis package (pip install redis)")
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(self.prefix + "entry:" + key)
+
+    def set(self, key: str, entry: bytes, ttl: float):
+        self.client.set(self.prefix + "entry:" + key, entry, ex=max(1, math.ceil(ttl)))
+
+    def versions(self, tables: Iterable[str]) -> tuple:
+        values = self.client.mget([self.prefix + "version:" + table for table in tables])
+        return tuple(int(value or 0) for value in values)
+
+    def bump(self, tables: Iterable[str]):
+        pipeline = self.client.pipeline(transaction=False)
+        for table in tables:
+            pipeline.incr(self.prefix + "version:" + table)
+        pipeline.execute()
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "entry:*"):
+            self.client.delete(key)
+
+
+def create_backend():
+    if RESPONSE_CACHE_URL:
+        return RedisResponseCache(RESPONSE_CACHE_URL)
+    return InMemoryResponseCache()
+
+
+_backend = None
+
+
+# the configured backend, created on first use
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+# ---- table versions: every committed write to a watched table bumps its version, which is part of
+# ---- the key of every response read from it, so the next request misses and reads the new rows
+
+def _changed_tables(session: Session) -> set:
+    return session.info.setdefault("response_cache_tables", set())
+
+
+@event.listens_for(Session, "after_flush")
+def _record_flushed_tables(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        if table in _WATCHED_TABLES:
+            _changed_tables(session).add(table)
+
+
+# bulk insert/update/delete statements run through session.execute() and skip the flush
+@event.listens_for(Session, "do_orm_execute")
+def _record_executed_tables(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement.table, "name", None)
+        if table in _WATCHED_TABLES:
+            _changed_tables(orm_execute_state.session).add(table)
+
+
+# a commit made through AsyncSession.run_sync runs on the event loop, so a backend that blocks is
+# bumped on the threadpool instead; requests on this worker wait for those bumps before they read
+# table versions, so they still see their own writes
+_pending_bumps = set()
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_committed_tables(session):
+    tables = session.info.pop("response_cache_tables", None)
+    if not tables:
+        return
+    backend = get_backend()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if not backend.blocking or loop is None:
+        backend.bump(sorted(tables))
+        return
+    bump = loop.run_in_executor(None, backend.bump, sorted(tables))
+    _pending_bumps.add(bump)
+    bump.add_done_callback(_bump_done)
+
+
+def _bump_done(bump):
+    _pending_bumps.discard(bump)
+    if not bump.cancelled() and bump.exception() is not None:
+        logger.error("Could not bump response cache table versions", exc_info=bump.exception())
+
+
+async def _wait_for_bumps():
+    loop = asyncio.get_running_loop()
+    pending = [bump for bump in _pending_bumps if bump.get_loop() is loop]
+    if pending:
+        await asyncio.wait(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_tables(session):
+    session.info.pop("response_cache_tables", None)
+
+
+async def _call(backend, method, *args):
+    if backend.blocking:
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+
+# caches successful anonymous GET responses of the routes in POLICIES. Requests carrying credentials
+# are never cached or served from the cache. Responses say X-Cache: hit or miss.
+class ResponseCacheMiddleware:
+    def __init__(self, app, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or scope["method"] != "GET":
+            return await self.app(scope, receive, send)
+        policy = find_policy(scope["path"])
+        if policy is None or any(name == b"authorization" for name, _ in scope["headers"]):
+            return await self.app(scope, receive, send)
+
+        backend = get_backend()
+        await _wait_for_bumps()
+        versions = await _call(backend, backend.versions, policy.tables)
+        key = f"{scope['path']}?{normalize_query(scope['query_string'])}#{'.'.join(map(str, versions))}"
+        entry = await _call(backend, backend.get, key)
+        if entry is not None:
+            content_type, body = _decode(entry)
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(body)).encode()),
+                (b"x-cache", b"hit"),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        start = None
+        chunks = []
+        size = 0
+
+        async def send_and_capture(message):
+            nonlocal start, size
+            if message["type"] == "http.response.start":
+                start = message
+                message = {**message, "headers": [*message.get("headers", []), (b"x-cache", b"miss")]}
+            elif message["type"] == "http.response.body" and start is not None and start["status"] == 200:
+                size += len(message.get("body", b""))
+                if size <= RESPONSE_CACHE_MAX_BODY:
+                    chunks.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, receive, send_and_capture)
+        if start is not None and start["status"] == 200 and size <= RESPONSE_CACHE_MAX_BODY:
+            content_type = dict(start.get("headers", [])).get(b"content-type", b"application/json")
+            await _call(backend, backend.set, key, _encode(content_type, b"".join(chunks)), policy.ttl)
@@ -0,0 +1,125 @@
+import hashlib
+import heapq
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis is only needed when TOKEN_REVOCATION_URL is set
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# redis://host:6379/0 to share logouts between workers and keep them across restarts;
+# unset keeps them in this process
+TOKEN_REVOCATION_URL = os.getenv("TOKEN_REVOCATION_URL")
+# revoked tokens kept in memory; when that many are live, further logouts are refused rather than
+# forgetting one, which would make its token valid again
+TOKEN_REVOCATION_MAX_ENTRIES = int(os.getenv("TOKEN_REVOCATION_MAX_ENTRIES", "100000"))
+
+
+# what a revocation is keyed by: the token's jti, or a digest of the token itself for tokens issued without one
+def token_id(token: str, claims: dict) -> str:
+    return claims.get("jti") or hashlib.sha256(token.encode()).hexdigest()
+
+
+class RevocationStoreFull(Exception):
+    pass
+
+
+# revoked token ids until their token would have expired anyway; lookups are a dict hit and
+# expired entries are purged from a heap ordered by expiry as new ones arrive. Live entries are never
+# dropped: a revocation that does not fit raises RevocationStoreFull.
+class InMemoryRevocationStore:
+    def __init__(self, max_entries: int = TOKEN_REVOCATION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._expiries: Dict[str, float] = {}
+        self._heap = []  # (expires_at, token id)
+        self._lock = threading.Lock()
+
+    # expires_at is the token's exp, in seconds since the epoch
+    async def revoke(self, jti: str, expires_at: float):
+        now = time.time()
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._purge(now)
+            if jti not in self._expiries and len(self._expiries) >= self.max_entries:
+                logger.warning("Token revocation store is full (%d live revocations)", len(self._expiries))
+                raise RevocationStoreFull(jti)
+            if expires_at > self._expiries.get(jti, 0):
+                self._expiries[jti] = expires_at
+                heapq.heappush(self._heap, (expires_at, jti))
+
+    async def is_revoked(self, jti: str) -> bool:
+        expires_at = self._expiries.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def _purge(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, jti = heapq.heappop(self._heap)
+            if self._expiries.get(jti) == expires_at:  # otherwise revoked again later; a newer entry covers it
+                del self._expiries[jti]
+
+    async def close(self):
+        with self._lock:
+            self._expiries.clear()
+            self._heap.clear()
+
+    def __len__(self) -> int:
+        return len(self._expiries)
+
+
+# one Redis key per revoked token, expiring with it, so every worker sees a logout at once
+class RedisRevocationStore:
+    prefix = "auth:revoked:"
+
+    def __init__(self, url: Optional[str] = None, client=None):
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("TOKEN_REVOCATION_URL needs the redis package (pip install redis)")
+            client = aioredis.from_url(url)
+        self.client = client
+
+    async def revoke(self, jti: str, expires_at: float):
+        ttl = int(expires_at - time.time()) + 1
+        if ttl > 1:
+            await self.client.set(self.prefix + jti, 1, ex=ttl)
+
+    async def is_revoked(self, jti: str) -> bool:
+        return bool(await self.client.exists(self.prefix + jti))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_revocation_store():
+    if TOKEN_REVOCATION_URL:
+        return RedisRevocationStore(TOKEN_REVOCATION_URL)
+    return InMemoryRevocationStore()
+
+
+_store = None
+
+
+# the configured store, created on first use
+def get_revocation_store():
+    global _store
+    if _store is None:
+        _store = create_revocation_store()
+    return _store
+
+
+def set_revocation_store(store):
+    global _store
+    _store = store
+
+
+async def close_revocation_store():
+    global _store
+    if _store is not None:
+        await _store.close()
+        _store = None
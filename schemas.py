@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, ConfigDict, Field
+from typing import Dict, List, Optional
 import enum
 from datetime import datetime
 
@@ -24,6 +24,21 @@ class StatusAdvertisementEnum(str, enum.Enum):
     SOLD = "SOLD"
     RESERVED = "RESERVED"
 
+#----for SORTING search results-------#
+class AdvertisementSortEnum(str, enum.Enum):
+    RECENT = "recent"
+    RELEVANCE = "relevance"
+
+#----for incremental EXPORTS-------#
+class ExportSinceFieldEnum(str, enum.Enum):
+    CREATED_AT = "created_at"
+    UPDATED_AT = "updated_at"
+
+#----for bulk IMPORTS-------#
+class ImportFormatEnum(str, enum.Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
 #----for CHANGING STATUS-------#
 class StatusChangeAdvertisementEnum(str, enum.Enum):
     SOLD = "SOLD"
@@ -94,6 +109,24 @@ class AdvertisementEditBase(BaseModel):
     status: Optional[StatusAdvertisementEnum] = None
     category_id: Optional[int] = None
 
+#one row of a bulk import (CSV columns or NDJSON keys); created_at defaults to the import time
+class AdvertisementImportRow(BaseModel):
+    title: str = Field(min_length=1)
+    content: str = ""  # advertisements are always displayed with a content string
+    price: float = Field(gt=0)
+    status: StatusAdvertisementEnum = StatusAdvertisementEnum.OPEN
+    category_id: int
+    created_at: Optional[datetime] = None
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+class AdvertisementImportReport(BaseModel):
+    imported: int
+    failed: int
+    errors: List[ImportRowError]
+
 #for updating status
 class AdvertisementStatusDisplay(BaseModel):
     status: StatusChangeAdvertisementEnum
@@ -111,6 +144,14 @@ class CategoryDisplay(BaseModel):
     advertisements: List[Advertisement]  
     model_config = ConfigDict(from_attributes=True)
 
+# category navigation: counts instead of the advertisements themselves
+class CategorySummary(BaseModel):
+    id: int
+    title: str
+    advertisement_count: int
+    open_advertisement_count: int
+    model_config = ConfigDict(from_attributes=True)
+
 AdvertisementDisplay.model_rebuild()
 CategoryDisplay.model_rebuild()        
     
@@ -122,6 +163,10 @@ class ImageOrderDisplay(BaseModel):
 class ImageAllDisplay(BaseModel):
     order_id:int
     image_path: str
+    # resized copies; the original's url until they have been generated
+    thumbnail_url: str
+    medium_url: str
+    webp_url: str
     model_config = ConfigDict(from_attributes=True)
     # class Config():
     #     orm_mode = True
@@ -148,6 +193,29 @@ class ImageOneDisplay(BaseModel):
 
 
 
+# direct uploads: the client hashes the image, asks for an upload url, sends the bytes there and confirms
+class ImageUploadRequest(BaseModel):
+    filename: str
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+    size: int = Field(gt=0)
+    content_type: Optional[str] = None
+
+class ImageUploadTicket(BaseModel):
+    file_name: str
+    # the same content is stored already: skip sending it and confirm right away
+    already_stored: bool
+    method: Optional[str] = None
+    url: Optional[str] = None
+    headers: Dict[str, str] = {}
+    # False when url is the API's own upload endpoint, which records the image itself
+    confirm: bool = True
+
+class ImageUploadConfirm(BaseModel):
+    filename: str
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+
+
+
 class Image(BaseModel):
     order_id:int
     original_name:str
@@ -219,4 +287,26 @@ class AdvertisementWithRating(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
     # class Config:
-    #     orm_mode = True    
\ No newline at end of file
+    #     orm_mode = True
+
+
+#--------------- paginated advertisement lists ---------
+class AdvertisementPage(BaseModel):
+    items: List[AdvertisementWithRating]
+    next_cursor: Optional[str] = None
+
+
+#--------------- chat history ---------
+class MessageDisplay(BaseModel):
+    id: int
+    advertisement_id: int
+    sender_id: int
+    receiver_id: int
+    content: str
+    created_at: datetime
+    delivered: bool
+    model_config = ConfigDict(from_attributes=True)
+
+class MessagePage(BaseModel):
+    items: List[MessageDisplay]
+    next_cursor: Optional[str] = None
@@ -1,16 +1,41 @@
+import asyncio
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 
+logger = logging.getLogger(__name__)
+
 # Secret key and algo for JWT (keep secret key safe in environment variables)
 SECRET_KEY = "your_secret_key_here_change_this"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor; hashes made with another cost are replaced at the user's next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt runs on its own threads (it releases the GIL), so a login burst cannot take the threadpool
+# that serves every other route; beyond the queue limit requests get 503 instead of waiting
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+PASSWORD_HASH_MAX_PENDING = PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_lock = threading.Lock()
+_hash_stats = {"pending": 0, "completed": 0, "rejected": 0}
+
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -20,11 +45,59 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+# queue depth of the password hashing pool: pending counts running and waiting jobs
+def password_hash_stats() -> dict:
+    with _hash_lock:
+        stats = dict(_hash_stats)
+    stats["running"] = min(stats["pending"], PASSWORD_HASH_WORKERS)
+    stats["queued"] = stats["pending"] - stats["running"]
+    stats["workers"] = PASSWORD_HASH_WORKERS
+    stats["max_queue"] = PASSWORD_HASH_MAX_QUEUE
+    return stats
+
+
+async def _run_in_hash_pool(fn, *args):
+    with _hash_lock:
+        if _hash_stats["pending"] >= PASSWORD_HASH_MAX_PENDING:
+            _hash_stats["rejected"] += 1
+            logger.warning("Password hashing queue is full (%d pending)", _hash_stats["pending"])
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many sign-ins at once, please retry", headers={"Retry-After": "1"})
+        _hash_stats["pending"] += 1
+    submitted = False
+    try:
+        job = _hash_executor.submit(fn, *args)
+        submitted = True
+    finally:
+        if not submitted:
+            _release_hash_slot(None)
+    # the slot is given back when the job itself ends: a request cancelled while its job runs
+    # still has a worker busy until bcrypt returns, and one cancelled while queued cancels the job
+    job.add_done_callback(_release_hash_slot)
+    return await asyncio.wrap_future(job)
+
+
+def _release_hash_slot(job):
+    with _hash_lock:
+        _hash_stats["pending"] -= 1
+        if job is not None and not job.cancelled():
+            _hash_stats["completed"] += 1
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_in_hash_pool(pwd_context.hash, password)
+
+
+# returns whether the password matches and, when the stored hash uses an outdated cost, its replacement
+async def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await _run_in_hash_pool(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (
         expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     )
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})  # jti: what a logout revokes
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -0,0 +1,170 @@
+import base64
+import contextlib
+import mimetypes
+import os
+import shutil
+import tempfile
+from typing import Iterator, Optional
+from utils.http_cache import IMMUTABLE_CACHE_CONTROL
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 is only needed for IMAGE_STORAGE=s3
+    boto3 = None
+
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "local")
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploaded_images")
+# where clients fetch stored files; defaults to the app's own /images mount, or the bucket for s3
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL")
+S3_BUCKET = os.getenv("S3_BUCKET", "marketplace-images")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. http://localhost:9000 for MinIO
+S3_REGION = os.getenv("S3_REGION")
+PRESIGNED_UPLOAD_EXPIRES = int(os.getenv("PRESIGNED_UPLOAD_EXPIRES", "900"))
+
+
+def _content_type(name: str, content_type: Optional[str] = None) -> str:
+    return content_type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+# image files in a directory on this machine, served by the app's /images mount
+class LocalStorage:
+    is_local = True
+
+    def __init__(self, directory: str, base_url: Optional[str] = None):
+        self.directory = directory
+        self.base_url = (base_url or "http://127.0.0.1:8000/images").rstrip("/")
+
+    def local_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # takes ownership of local_path: the file is moved into place
+    def save(self, local_path: str, name: str, content_type: Optional[str] = None):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.abspath(local_path) != os.path.abspath(self.local_path(name)):
+            os.replace(local_path, self.local_path(name))
+
+    def delete(self, name: str):
+        path = self.local_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def size(self, name: str) -> Optional[int]:
+        path = self.local_path(name)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def read_head(self, name: str, length: int) -> bytes:
+        with open(self.local_path(name), "rb") as file:
+            return file.read(length)
+
+    @contextlib.contextmanager
+    def local_copy(self, name: str) -> Iterator[str]:
+        yield self.local_path(name)
+
+    def public_url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+    # clients send their bytes to the API itself (PUT .../upload_image)
+    def presigned_upload(self, name: str, content_type: str, sha256: str) -> Optional[dict]:
+        return None
+
+
+# image files in an S3-compatible bucket (AWS S3, MinIO, ...); clients download them from the bucket
+# (or a CDN in front of it) and upload them with pre-signed URLs, so image bytes never pass the API
+class S3Storage:
+    is_local = False
+
+    def __init__(self, bucket: str, base_url: Optional[str] = None, endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("IMAGE_STORAGE=s3 needs boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region, config=Config(
+                signature_version="s3v4",
+                s3={"addressing_style": "path" if endpoint_url else "auto"},
+            ))
+        self.client = client
+        self.bucket = bucket
+        if not base_url:
+            base_url = f"{endpoint_url}/{bucket}" if endpoint_url else f"https://{bucket}.s3.amazonaws.com"
+        self.base_url = base_url.rstrip("/")
+
+    def local_path(self, name: str) -> Optional[str]:
+        return None
+
+    def save(self, local_path: str, name: str, content_type: Optional[str] = None):
+        self.client.upload_file(local_path, self.bucket, name, ExtraArgs={
+            "ContentType": _content_type(name, content_type),
+            "CacheControl": IMMUTABLE_CACHE_CONTROL,
+        })
+        os.remove(local_path)
+
+    def delete(self, name: str):
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+    def size(self, name: str) -> Optional[int]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)["ContentLength"]
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def read_head(self, name: str, length: int) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=name, Range=f"bytes=0-{length - 1}")["Body"].read()
+
+    @contextlib.contextmanager
+    def local_copy(self, name: str) -> Iterator[str]:
+        directory = tempfile.mkdtemp(prefix="image-")
+        try:
+            path = os.path.join(directory, name)
+            self.client.download_file(self.bucket, name, path)
+            yield path
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def public_url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+    # the signed x-amz-checksum-sha256 header makes the bucket reject any body whose hash differs,
+    # so a content-addressed key can only ever hold the content it is named after
+    def presigned_upload(self, name: str, content_type: str, sha256: str) -> Optional[dict]:
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        headers = {
+            "Content-Type": content_type,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+            "x-amz-checksum-sha256": checksum,
+        }
+        url = self.client.generate_presigned_url("put_object", Params={
+            "Bucket": self.bucket,
+            "Key": name,
+            "ContentType": content_type,
+            "CacheControl": IMMUTABLE_CACHE_CONTROL,
+            "ChecksumSHA256": checksum,
+        }, ExpiresIn=PRESIGNED_UPLOAD_EXPIRES)
+        return {"method": "PUT", "url": url, "headers": headers}
+
+
+def create_storage():
+    if IMAGE_STORAGE == "s3":
+        return S3Storage(S3_BUCKET, IMAGE_BASE_URL, S3_ENDPOINT_URL, S3_REGION)
+    if IMAGE_STORAGE != "local":
+        raise ValueError(f"Unknown IMAGE_STORAGE {IMAGE_STORAGE!r}, expected 'local' or 's3'")
+    return LocalStorage(UPLOAD_DIR, IMAGE_BASE_URL)
+
+
+_storage = None
+
+
+# the configured backend, created on first use
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+
+def set_storage(backend):
+    global _storage
+    _storage = backend
@@ -1,9 +1,37 @@
 from fastapi.testclient import TestClient
+from fastapi import HTTPException
 from main import app
+import anyio
+import bcrypt
+import asyncio
+import hashlib
+import os
+import time
 import uuid
+import pytest
 from unittest.mock import patch
 from db.db_advertisement import get_filtered_advertisements
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import Session
+from db.database import Base, SessionLocal, async_engine, engine
+from db import migrations
+from db.migrations import create_missing_indexes
+from db.model import (
+    DbAdvertisement,
+    DbCategory,
+    DbImage,
+    DbImageBlob,
+    DbRating,
+    DbSellerRatingStats,
+    DbTransaction,
+    DbUser,
+    StatusAdvertisementEnum,
+)
+from db.db_rating_stats import rebuild_seller_rating_stats
+from utils import image_processing, uploads
+from db import db_image
 
+migrations.upgrade(engine)
 client = TestClient(app)
 
 # Helper function to register a user with a unique email each time
@@ -152,20 +180,1164 @@ ads = [
 
 @patch("db.db_advertisement.get_filtered_advertisements")
 def test_search_by_keyword(mock_get_filtered):
-    mock_get_filtered.return_value = [ads[0], ads[2]]
+    mock_get_filtered.return_value = {"items": [ads[0], ads[2]], "next_cursor": None}
     response = client.get(
         "/advertisements/search", params={"search": "bike", "category": "vehicles"}
     )
     assert response.status_code == 200
     assert response.json() == mock_get_filtered.return_value
-    assert len(response.json()) == 2
+    assert len(response.json()["items"]) == 2
 
 
 @patch("db.db_advertisement.get_filtered_advertisements")
 def test_no_results(mock_get_filtered):
-    mock_get_filtered.return_value = []
+    mock_get_filtered.return_value = {"items": [], "next_cursor": None}
     response = client.get(
         "/advertisements/search", params={"search": "shoes", "category": "vehicles"}
     )
     assert response.status_code == 200
-    assert response.json() == []
+    assert response.json()["items"] == []
+
+
+def create_test_category(title="test category"):
+    db = SessionLocal()
+    try:
+        category = DbCategory(title=title)
+        db.add(category)
+        db.commit()
+        return category.id
+    finally:
+        db.close()
+
+
+def create_test_advertisement(token, title, content="content", category_id=None, created_at="2025-06-02T16:26:10.100000"):
+    headers = {"Authorization": f"Bearer {token}"}
+    if category_id is None:
+        category_id = create_test_category()
+    response = client.post(
+        "/advertisements/create",
+        json={
+            "title": title,
+            "content": content,
+            "price": 10,
+            "status": "OPEN",
+            "created_at": created_at,
+            "category_id": category_id,
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200, response.json()
+    return response.json()
+
+
+def latest_advertisement_id(user_id):
+    db = SessionLocal()
+    try:
+        return (
+            db.query(DbAdvertisement.id)
+            .filter(DbAdvertisement.user_id == user_id)
+            .order_by(DbAdvertisement.id.desc())
+            .first()[0]
+        )
+    finally:
+        db.close()
+
+
+# for work done in the background: file removals after a commit, delivery marks from chat sockets
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_search_matches_word_prefixes():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    word = f"zebra{uuid.uuid4().hex[:8]}"
+    create_test_advertisement(token, f"Striped {word} lamp")
+
+    response = client.get("/advertisements/search", params={"search": word[:9]})
+    assert response.status_code == 200
+    titles = [ad["advertisement"]["title"] for ad in response.json()["items"]]
+    assert f"Striped {word} lamp" in titles
+
+    response = client.get("/advertisements/search", params={"search": f"{word} lamp", "sort": "relevance"})
+    assert response.status_code == 200
+    assert response.json()["items"][0]["advertisement"]["title"] == f"Striped {word} lamp"
+
+
+def test_search_falls_back_to_like_without_the_search_index():
+    plain_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=plain_engine)
+    db = Session(bind=plain_engine)
+    try:
+        user = DbUser(username="no fts", email="nofts@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        db.add(DbAdvertisement(title="Unindexed lamp", content="c", price=1, user_id=user.id))
+        db.commit()
+        page = get_filtered_advertisements(db, "lamp")
+        assert [item["advertisement"].title for item in page["items"]] == ["Unindexed lamp"]
+    finally:
+        db.close()
+
+
+def test_all_advertisements_cursor_pagination():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    category_id = create_test_category()
+    for i in range(3):
+        create_test_advertisement(token, f"paged ad {i}", category_id=category_id, created_at="2099-01-01T00:00:00")
+
+    titles = []
+    cursor = None
+    for _ in range(3):
+        params = {"limit": 1, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/advertisements/all", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) == 1
+        titles.append(page["items"][0]["advertisement"]["title"])
+        cursor = page["next_cursor"]
+        assert cursor
+    assert titles == ["paged ad 2", "paged ad 1", "paged ad 0"]
+
+    response = client.get("/advertisements/all", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+
+def test_seller_rating_stats_follow_new_ratings():
+    seller_response, seller_email = register_test_user()
+    _, buyer_email = register_test_user()
+    seller_id = seller_response.json()["id"]
+    seller_token = login_test_user(seller_email)
+    buyer_token = login_test_user(buyer_email)
+    category_id = create_test_category()
+
+    for score in (4, 5):
+        create_test_advertisement(seller_token, "rated ad", category_id=category_id)
+        ad_id = latest_advertisement_id(seller_id)
+        response = client.post(
+            "/purchase/transactions",
+            json={"advertisement_id": ad_id, "completed": True},
+            headers={"Authorization": f"Bearer {buyer_token}"},
+        )
+        assert response.status_code == 201, response.json()
+        response = client.post(
+            "/ratings/",
+            json={"transaction_id": response.json()["id"], "score": score},
+            headers={"Authorization": f"Bearer {buyer_token}"},
+        )
+        assert response.status_code == 200, response.json()
+
+    db = SessionLocal()
+    try:
+        stats = db.get(DbSellerRatingStats, seller_id)
+        assert (stats.rating_count, stats.rating_sum, stats.average_rating) == (2, 9, 4.5)
+        rebuild_seller_rating_stats(db)
+        db.expire_all()
+        stats = db.get(DbSellerRatingStats, seller_id)
+        assert (stats.rating_count, stats.rating_sum, stats.average_rating) == (2, 9, 4.5)
+    finally:
+        db.close()
+
+    # deleting the ad deletes its transaction and rating, which leave the totals too
+    response = client.delete(f"/advertisements/{ad_id}", headers={"Authorization": f"Bearer {seller_token}"})
+    assert response.status_code == 200, response.json()
+    db = SessionLocal()
+    try:
+        stats = db.get(DbSellerRatingStats, seller_id)
+        assert (stats.rating_count, stats.rating_sum, stats.average_rating) == (1, 4, 4.0)
+        rebuild_seller_rating_stats(db)
+        db.expire_all()
+        stats = db.get(DbSellerRatingStats, seller_id)
+        assert (stats.rating_count, stats.rating_sum, stats.average_rating) == (1, 4, 4.0)
+    finally:
+        db.close()
+
+
+def test_concurrent_first_ratings_of_a_seller_share_one_totals_row():
+    from concurrent.futures import ThreadPoolExecutor
+    from db.db_rating_stats import add_seller_rating
+    seller_response, _ = register_test_user()
+    seller_id = seller_response.json()["id"]
+
+    def rate(score):
+        db = SessionLocal()
+        try:
+            add_seller_rating(db, seller_id, score)
+            db.commit()
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(rate, [1, 2, 3, 4]))
+    db = SessionLocal()
+    try:
+        stats = db.get(DbSellerRatingStats, seller_id)
+        assert (stats.rating_count, stats.rating_sum, stats.average_rating) == (4, 10, 2.5)
+    finally:
+        db.close()
+
+
+def count_statements(request):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = (engine, async_engine.sync_engine)
+    for bind in engines:
+        event.listen(bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = request()
+    finally:
+        for bind in engines:
+            event.remove(bind, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_listing_statement_count_does_not_grow_with_page_size():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    # distinct categories, so lazy loads could not be answered from the identity map
+    for i in range(6):
+        create_test_advertisement(token, f"eager ad {i}", category_id=create_test_category(f"category {i}"))
+
+    for path, params in (("/advertisements/all", {}), ("/advertisements/search", {"search": "eager"})):
+        one = count_statements(lambda: client.get(path, params={**params, "limit": 1}))
+        many = count_statements(lambda: client.get(path, params={**params, "limit": 6}))
+        assert 0 < one == many
+
+    ad_id = latest_advertisement_id(response.json()["id"])
+    assert 0 < count_statements(lambda: client.get(f"/advertisements/{ad_id}")) <= 2
+
+
+def query_plan(statement):
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return " | ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+
+
+def test_hot_queries_use_indexes():
+    hot_queries = {
+        "ix_advertisement_created_at": select(DbAdvertisement)
+        .order_by(DbAdvertisement.created_at.desc(), DbAdvertisement.id.desc())
+        .limit(20),
+        "ix_advertisement_category_id_created_at": select(DbAdvertisement)
+        .where(DbAdvertisement.category_id == 1)
+        .order_by(DbAdvertisement.created_at.desc(), DbAdvertisement.id.desc())
+        .limit(20),
+        "ix_advertisement_status_created_at": select(DbAdvertisement)
+        .where(DbAdvertisement.status == StatusAdvertisementEnum.OPEN)
+        .order_by(DbAdvertisement.created_at)
+        .limit(20),
+        "ix_image_advertisement_id_order_id": select(DbImage)
+        .where(DbImage.advertisement_id == 1)
+        .order_by(DbImage.order_id),
+        "ix_ratings_ratee_id": select(DbRating).where(DbRating.ratee_id == 1),
+        "ux_ratings_transaction_id_rater_id": select(DbRating).where(
+            DbRating.transaction_id == 1, DbRating.rater_id == 1
+        ),
+        "ix_transactions_advertisement_id": select(DbTransaction).where(
+            DbTransaction.advertisement_id == 1
+        ),
+    }
+    for index_name, statement in hot_queries.items():
+        plan = query_plan(statement)
+        assert f"USING INDEX {index_name}" in plan or f"USING COVERING INDEX {index_name}" in plan, plan
+
+
+def test_migration_adds_missing_indexes():
+    old_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=old_engine)
+    with old_engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_advertisement_category_id_created_at")
+        conn.exec_driver_sql("DROP INDEX ux_ratings_transaction_id_rater_id")
+
+    assert sorted(create_missing_indexes(old_engine)) == [
+        "ix_advertisement_category_id_created_at",
+        "ux_ratings_transaction_id_rater_id",
+    ]
+    assert create_missing_indexes(old_engine) == []
+
+
+def test_migration_keeps_the_latest_of_duplicate_ratings():
+    old_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=old_engine)
+    with old_engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ux_ratings_transaction_id_rater_id")
+        conn.exec_driver_sql("INSERT INTO user (id, username, email, hashed_password) VALUES (1, 'a', 'a@example.com', 'x'), (2, 'b', 'b@example.com', 'x')")
+        conn.exec_driver_sql("INSERT INTO transactions (id, buyer_id, seller_id, created_at, advertisement_id) VALUES (1, 1, 2, '2025-01-01', 1)")
+        conn.exec_driver_sql("INSERT INTO ratings (transaction_id, rater_id, ratee_id, score) VALUES (1, 1, 2, 1), (1, 1, 2, 5), (1, 2, 1, 4)")
+
+    assert "index ux_ratings_transaction_id_rater_id" in migrations.upgrade(old_engine)
+    with old_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT rater_id, score FROM ratings ORDER BY rater_id").all() == [(1, 5), (2, 4)]
+        assert conn.exec_driver_sql("SELECT seller_id, average_rating FROM seller_rating_stats").all() == [(2, 5)]
+
+
+def test_file_backed_sqlite_engines_get_a_sized_queue_pool(tmp_path):
+    from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+    from db.database import DB_POOL_SIZE, create_db_engine
+    sync_engine = create_db_engine(f"sqlite:///{tmp_path / 'pool.db'}")
+    aio_engine = create_db_engine(f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}", is_async=True)
+    try:
+        assert type(sync_engine.pool) is QueuePool and sync_engine.pool.size() == DB_POOL_SIZE
+        assert type(aio_engine.pool) is AsyncAdaptedQueuePool and aio_engine.pool.size() == DB_POOL_SIZE
+    finally:
+        sync_engine.dispose()
+        asyncio.run(aio_engine.dispose())
+
+
+def test_sqlite_connections_use_wal_and_busy_timeout():
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() > 0
+
+
+def test_uploaded_image_gets_resized_variants(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    path = tmp_path / "photo.png"
+    Image.new("RGB", (1600, 1200), "red").save(path)
+
+    assert image_processing.generate_variants(str(path), "photo.png") == ["thumbnail", "medium", "webp"]
+    with Image.open(tmp_path / "photo_thumbnail.png") as thumbnail:
+        assert thumbnail.size == (200, 150)
+    with Image.open(tmp_path / "photo_webp.webp") as webp:
+        assert webp.format == "WEBP" and webp.size == (800, 600)
+
+    # variants keep the upload's format, also after the EXIF rotation is applied
+    Image.new("RGB", (1600, 1200), "blue").save(tmp_path / "photo.jpg", format="JPEG")
+    image_processing.generate_variants(str(tmp_path / "photo.jpg"), "photo.jpg")
+    for name in ("photo_thumbnail.jpg", "photo_medium.jpg"):
+        with Image.open(tmp_path / name) as variant:
+            assert variant.format == "JPEG"
+
+
+def test_streamed_image_upload_checks_content_and_size(monkeypatch):
+    response, email = register_test_user()
+    token = login_test_user(email)
+    create_test_advertisement(token, "upload ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/octet-stream"}
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+    response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "a.png"}, content=png, headers=headers)
+    assert response.status_code == 200, response.json()
+    assert response.json()["order_id"] == 1
+
+    response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "b.png"}, content=b"GIF89a" + b"\x00" * 100, headers=headers)
+    assert response.status_code == 400
+
+    monkeypatch.setattr(uploads, "MAX_IMAGE_UPLOAD_BYTES", 50)
+    response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "c.png"}, content=png, headers=headers)
+    assert response.status_code == 413
+    assert not [name for name in os.listdir(db_image.UPLOAD_DIR) if name.endswith(".part")]
+
+
+def test_form_upload_is_limited_and_image_limit_is_checked_on_insert(monkeypatch):
+    response, email = register_test_user()
+    token = login_test_user(email)
+    create_test_advertisement(token, "form upload ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    headers = {"Authorization": f"Bearer {token}"}
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+    response = client.post(f"/advertisements/{ad_id}/add_images", files={"image": ("a.png", png, "image/png")}, headers=headers)
+    assert response.status_code == 200, response.json()
+    assert response.json()["order_id"] == 1
+
+    monkeypatch.setattr(uploads, "MAX_IMAGE_UPLOAD_BYTES", 50)
+    monkeypatch.setattr(uploads, "MULTIPART_OVERHEAD", 10)
+    response = client.post(f"/advertisements/{ad_id}/add_images", files={"image": ("b.png", png, "image/png")}, headers=headers)
+    assert response.status_code == 413
+    monkeypatch.undo()
+
+    # uploads that passed the early check together get their order_id, and the limit, from the insert
+    db = SessionLocal()
+    try:
+        for number in range(2, 6):
+            digest = uuid.uuid4().hex
+            assert db_image._record_image(ad_id, "p.png", "image/png", digest, f"{digest}.png", 10, db).order_id == number
+        with pytest.raises(HTTPException) as error:
+            db_image._record_image(ad_id, "p.png", "image/png", "f" * 64, "f" * 64 + ".png", 10, db)
+        assert error.value.status_code == 400
+        assert db.get(DbImageBlob, "f" * 64) is None
+    finally:
+        db.close()
+
+
+def test_identical_uploads_share_one_blob_until_last_reference_goes():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    user_id = response.json()["id"]
+    png = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    image_ids = []
+    for title in ("first ad", "second ad"):
+        create_test_advertisement(token, title)
+        ad_id = latest_advertisement_id(user_id)
+        response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "same.png"}, content=png, headers=headers)
+        assert response.status_code == 200, response.json()
+        image_ids.append(response.json()["id"])
+
+    db = SessionLocal()
+    try:
+        images = [db.get(DbImage, image_id) for image_id in image_ids]
+        assert images[0].image_name == images[1].image_name
+        blob = db.get(DbImageBlob, images[0].blob_sha256)
+        assert blob.ref_count == 2
+        path = os.path.join(db_image.UPLOAD_DIR, blob.file_name)
+    finally:
+        db.close()
+
+    assert client.delete(f"/advertisements/delete_image/{image_ids[0]}", headers=headers).status_code == 200
+    assert os.path.exists(path)
+    assert client.delete(f"/advertisements/{ad_id}", headers=headers).status_code == 200
+    wait_until(lambda: not os.path.exists(path))
+
+
+def test_images_from_before_blobs_lose_their_file_only_once_the_delete_commits(monkeypatch):
+    response, email = register_test_user()
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    create_test_advertisement(token, "legacy image ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    name = f"legacy_{uuid.uuid4().hex}.png"
+    path = os.path.join(db_image.UPLOAD_DIR, name)
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+    db = SessionLocal()
+    try:
+        image = DbImage(order_id=1, original_name="old.png", image_name=name, image_path=path,
+                        image_type="image/png", advertisement_id=ad_id)
+        db.add(image)
+        db.commit()
+        image_id = image.id
+    finally:
+        db.close()
+
+    def failing_commit(self):
+        raise RuntimeError("commit failed")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(Session, "commit", failing_commit)
+        with pytest.raises(RuntimeError):
+            client.delete(f"/advertisements/delete_image/{image_id}", headers=headers)
+    time.sleep(0.1)
+    assert os.path.exists(path)
+
+    assert client.delete(f"/advertisements/delete_image/{image_id}", headers=headers).status_code == 200
+    wait_until(lambda: not os.path.exists(path))
+
+
+def test_upload_stores_the_file_again_when_its_blob_lost_the_file_meanwhile():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    user_id = response.json()["id"]
+    png = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    stored = os.path.join(db_image.UPLOAD_DIR, f"{hashlib.sha256(png).hexdigest()}.png")
+    ad_ids = []
+    for title in ("first blob ad", "second blob ad"):
+        create_test_advertisement(token, title)
+        ad_ids.append(latest_advertisement_id(user_id))
+
+    response = client.put(f"/advertisements/{ad_ids[0]}/upload_image", params={"filename": "a.png"}, content=png, headers=headers)
+    assert response.status_code == 200, response.json()
+    # the blob is still there when the next upload looks, but its file went with a release in between
+    os.remove(stored)
+    response = client.put(f"/advertisements/{ad_ids[1]}/upload_image", params={"filename": "b.png"}, content=png, headers=headers)
+    assert response.status_code == 200, response.json()
+    with open(stored, "rb") as file:
+        assert file.read() == png
+
+    # a removal queued for a released blob leaves the file of one created again alone
+    image_processing.remove_image_files(os.path.basename(stored))
+    assert os.path.exists(stored)
+
+
+def test_upload_removes_the_file_it_saved_when_the_row_is_not_written(monkeypatch):
+    response, email = register_test_user()
+    token = login_test_user(email)
+    create_test_advertisement(token, "failed record ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    png = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    stored = os.path.join(db_image.UPLOAD_DIR, f"{hashlib.sha256(png).hexdigest()}.png")
+
+    def fail(*args):
+        assert os.path.exists(stored)
+        raise HTTPException(status_code=409, detail="conflict")
+
+    monkeypatch.setattr(db_image, "_record_image", fail)
+    response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "a.png"},
+                          content=png, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 409
+    wait_until(lambda: not os.path.exists(stored))
+
+
+def test_image_delivery_is_cacheable_and_supports_ranges():
+    response, email = register_test_user()
+    token = login_test_user(email)
+    create_test_advertisement(token, "cached image ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    png = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    response = client.put(f"/advertisements/{ad_id}/upload_image", params={"filename": "photo.png"},
+                          content=png, headers={"Authorization": f"Bearer {token}"})
+    image_id = response.json()["id"]
+    image_name = response.json()["image_name"]
+
+    for url in (f"/advertisements/show_image/{image_id}", f"/images/{image_name}"):
+        response = client.get(url)
+        assert response.status_code == 200 and response.content == png
+        assert response.headers["etag"] == f'"{image_name.split(".")[0]}"'
+        # the content-addressed name never changes bytes; the image id can be deleted, so it is revalidated
+        if url.startswith("/images/"):
+            assert "immutable" in response.headers["cache-control"]
+        else:
+            assert response.headers["cache-control"] == "public, max-age=60, must-revalidate"
+
+        assert client.get(url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+        response = client.get(url, headers={"Range": "bytes=0-7"})
+        assert response.status_code == 206 and response.content == png[:8]
+        assert response.headers["content-range"] == f"bytes 0-7/{len(png)}"
+
+    # repeat views are answered from the location cache without touching the database
+    assert count_statements(lambda: client.get(f"/advertisements/show_image/{image_id}")) == 0
+
+    # a file gone from under a cached location is a 404, and the next view looks the image up again
+    os.remove(os.path.join(db_image.UPLOAD_DIR, image_name))
+    assert client.get(f"/advertisements/show_image/{image_id}").status_code == 404
+    assert db_image._image_locations.get(image_id) is None
+
+
+def test_direct_upload_to_s3_compatible_storage(monkeypatch):
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    from utils import storage
+    monkeypatch.setattr(image_processing, "Image", None)  # no background work against the mock bucket
+    response, email = register_test_user()
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    create_test_advertisement(token, "direct upload ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+    png = b"\x89PNG\r\n\x1a\n" + uuid.uuid4().bytes
+    sha256 = hashlib.sha256(png).hexdigest()
+
+    with moto.mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="test-images")
+        monkeypatch.setattr(storage, "_storage", storage.S3Storage("test-images", "https://cdn.example.com", client=s3))
+
+        body = {"filename": "photo.png", "sha256": sha256, "size": len(png)}
+        response = client.post(f"/advertisements/{ad_id}/image_upload_url", json=body, headers=headers)
+        assert response.status_code == 200, response.json()
+        ticket = response.json()
+        assert ticket["method"] == "PUT" and not ticket["already_stored"] and ticket["confirm"]
+        assert "x-amz-checksum-sha256" in ticket["headers"]
+
+        confirmation = {"filename": "photo.png", "sha256": sha256}
+        response = client.post(f"/advertisements/{ad_id}/confirm_image_upload", json=confirmation, headers=headers)
+        assert response.status_code == 404  # nothing was sent yet
+
+        s3.put_object(Bucket="test-images", Key=ticket["file_name"], Body=png)
+        response = client.post(f"/advertisements/{ad_id}/confirm_image_upload", json=confirmation, headers=headers)
+        assert response.status_code == 200, response.json()
+        assert response.json()["image_path"] == f"https://cdn.example.com/{sha256}.png"
+
+        response = client.get(f"/advertisements/show_image/{response.json()['id']}", follow_redirects=False)
+        assert response.headers["location"] == f"https://cdn.example.com/{sha256}.png"
+
+        response = client.post(f"/advertisements/{ad_id}/image_upload_url", json=body, headers=headers)
+        assert response.json()["already_stored"]
+
+
+def test_chat_message_reaches_the_ad_owner(monkeypatch):
+    seller, seller_email = register_test_user()
+    buyer, buyer_email = register_test_user()
+    seller_token, buyer_token = login_test_user(seller_email), login_test_user(buyer_email)
+    create_test_advertisement(seller_token, "chat ad")
+    seller_id, buyer_id = seller.json()["id"], buyer.json()["id"]
+    ad_id = latest_advertisement_id(seller_id)
+
+    # one event loop for both sockets, as under uvicorn (the test client otherwise starts one per socket)
+    with anyio.from_thread.start_blocking_portal() as portal:
+        monkeypatch.setattr(client, "portal", portal)
+        with client.websocket_connect(f"/chat/{seller_id}?token={seller_token}") as seller_socket, \
+                client.websocket_connect(f"/chat/{buyer_id}", headers={"Authorization": f"Bearer {buyer_token}"}) as buyer_socket:
+            buyer_socket.send_json({"receiver_id": seller_id, "advertisement_id": ad_id, "message": "still available?"})
+            assert seller_socket.receive_text() == f"User {buyer_id} (ad {ad_id}): still available?"
+            seller_socket.send_json({"receiver_id": buyer_id, "advertisement_id": ad_id, "message": "yes"})
+            assert buyer_socket.receive_text() == f"User {seller_id} (ad {ad_id}): yes"
+
+        # marked delivered once the receiving socket has sent them
+        headers = {"Authorization": f"Bearer {buyer_token}"}
+        history = lambda: client.get(f"/chat/history/{ad_id}", params={"other_user_id": seller_id}, headers=headers).json()["items"]
+        wait_until(lambda: all(m["delivered"] for m in history()))
+
+
+def test_redis_broker_routes_messages_between_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    from utils.broker import RedisBroker, user_channel
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        receiving_worker = RedisBroker(client=fakeredis.FakeAsyncRedis(server=server))
+        sending_worker = RedisBroker(client=fakeredis.FakeAsyncRedis(server=server))
+        received = asyncio.Queue()
+        await receiving_worker.subscribe(user_channel(7), received.put)
+        try:
+            assert await sending_worker.publish(user_channel(7), "hello") == 1
+            assert await asyncio.wait_for(received.get(), timeout=5) == "hello"
+            assert await sending_worker.publish(user_channel(8), "nobody") == 0
+            await receiving_worker.unsubscribe(user_channel(7), received.put)
+            assert await sending_worker.publish(user_channel(7), "gone") == 0
+        finally:
+            await receiving_worker.close()
+            await sending_worker.close()
+
+    asyncio.run(scenario())
+
+
+def test_chat_messages_are_stored_and_queued_for_offline_receivers(monkeypatch):
+    from starlette.websockets import WebSocketDisconnect
+    seller, seller_email = register_test_user()
+    buyer, buyer_email = register_test_user()
+    seller_token, buyer_token = login_test_user(seller_email), login_test_user(buyer_email)
+    create_test_advertisement(seller_token, "offline chat ad")
+    seller_id, buyer_id = seller.json()["id"], buyer.json()["id"]
+    ad_id = latest_advertisement_id(seller_id)
+
+    with anyio.from_thread.start_blocking_portal() as portal:
+        monkeypatch.setattr(client, "portal", portal)
+        with client.websocket_connect(f"/chat/{buyer_id}?token={buyer_token}") as buyer_socket:
+            for text in ("hello?", "anyone there?"):
+                buyer_socket.send_json({"receiver_id": seller_id, "advertisement_id": ad_id, "message": text})
+            # an error reply, sent after the two messages are handled
+            buyer_socket.send_json({"receiver_id": buyer_id, "advertisement_id": ad_id, "message": "me"})
+            assert buyer_socket.receive_text().startswith("Error")
+
+        # without the seller's own token the waiting messages are neither sent nor marked delivered
+        for url in (f"/chat/{seller_id}", f"/chat/{seller_id}?token={buyer_token}", f"/chat/{seller_id}?token=nonsense"):
+            with pytest.raises(WebSocketDisconnect) as refused:
+                with client.websocket_connect(url):
+                    pass
+            assert refused.value.code == 1008
+
+        with client.websocket_connect(f"/chat/{seller_id}?token={seller_token}") as seller_socket:
+            assert seller_socket.receive_text() == f"User {buyer_id} (ad {ad_id}): hello?"
+            assert seller_socket.receive_text() == f"User {buyer_id} (ad {ad_id}): anyone there?"
+
+        headers = {"Authorization": f"Bearer {buyer_token}"}
+        response = client.get(f"/chat/history/{ad_id}", params={"other_user_id": seller_id, "limit": 1}, headers=headers)
+        assert response.status_code == 200, response.json()
+        page = response.json()
+        assert [m["content"] for m in page["items"]] == ["anyone there?"]
+        assert page["items"][0]["delivered"] is True  # on reconnect
+
+        response = client.get(f"/chat/history/{ad_id}", params={"other_user_id": seller_id, "cursor": page["next_cursor"]}, headers=headers)
+        assert [m["content"] for m in response.json()["items"]] == ["hello?"]
+        assert response.json()["next_cursor"] is None
+
+
+def test_message_writer_retries_a_batch_until_the_database_takes_it(monkeypatch):
+    from db import db_message
+    from sqlalchemy.exc import OperationalError
+    stored, attempts = [], []
+
+    def flaky_save(rows):
+        attempts.append(len(rows))
+        if len(attempts) < 3:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        stored.extend(rows)
+
+    monkeypatch.setattr(db_message, "save_messages", flaky_save)
+
+    async def scenario():
+        writer = db_message.MessageWriter(flush_interval=0.01)
+        for text in ("one", "two"):
+            await writer.write(db_message.new_message(1, 2, 3, text, delivered=False))
+        await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(scenario())
+    assert attempts == [2, 2, 2]
+    assert [row["content"] for row in stored] == ["one", "two"]
+
+
+def test_message_writer_outage_does_not_hang_flushes(monkeypatch):
+    from sqlalchemy.exc import OperationalError
+    from db import db_message
+    attempts = []
+
+    def down(rows):
+        attempts.append(len(rows))
+        raise OperationalError("INSERT", {}, Exception("database is down"))
+
+    monkeypatch.setattr(db_message, "save_messages", down)
+    monkeypatch.setattr(db_message, "MESSAGE_RETRY_ATTEMPTS", 2)
+
+    async def scenario():
+        writer = db_message.MessageWriter(flush_interval=0.05)
+        await writer.write(db_message.new_message(1, 2, 3, "lost", delivered=False))
+        timed_out = await writer.flush(timeout=0.01)  # what a new socket or a history request waits at most
+        gave_up = await asyncio.wait_for(writer.flush(), timeout=5)  # the retries are bounded
+        await writer.close()
+        return timed_out, gave_up
+
+    assert asyncio.run(scenario()) == (False, True)
+    assert attempts == [1, 1, 1]
+
+
+def test_chat_ad_owner_lookups_are_cached_until_the_ad_changes(monkeypatch):
+    from db import db_advertisement
+    response, email = register_test_user()
+    token = login_test_user(email)
+    create_test_advertisement(token, "owner cache ad")
+    user_id = response.json()["id"]
+    ad_id = latest_advertisement_id(user_id)
+    loads = []
+    load = db_advertisement._load_advertisement_owner
+    monkeypatch.setattr(db_advertisement, "_load_advertisement_owner", lambda id: loads.append(id) or load(id))
+
+    async def owner():
+        return await db_advertisement.get_advertisement_owner(ad_id)
+
+    assert asyncio.run(owner()) == user_id
+    assert asyncio.run(owner()) == user_id
+    assert loads == [ad_id]
+
+    assert client.delete(f"/advertisements/{ad_id}", headers={"Authorization": f"Bearer {token}"}).status_code == 200
+    assert asyncio.run(owner()) is None
+    assert loads == [ad_id, ad_id]
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def close(self, code):
+        self.close_code = code
+
+
+def test_chat_connection_drops_or_closes_when_the_client_falls_behind(monkeypatch):
+    from router import chat
+    monkeypatch.setattr(chat, "CHAT_SEND_QUEUE_SIZE", 2)
+
+    confirmed = []
+
+    async def confirm(mark):
+        confirmed.append(mark)
+
+    async def fill(policy):
+        monkeypatch.setattr(chat, "CHAT_QUEUE_FULL_POLICY", policy)
+        connection = chat.ChatConnection(FakeSocket(), 1, on_sent=confirm)
+        for text in ("one", "two", "three"):
+            connection.send(text, text)
+        return connection
+
+    dropping = asyncio.run(fill("drop"))
+    assert dropping.outbox.qsize() == 2 and dropping.dropped == 1 and dropping.close_code is None
+    closing = asyncio.run(fill("close"))
+    assert closing.close_code == 1008
+
+    # only what reached the socket is reported sent; the dropped message stays undelivered
+    async def drain():
+        task = asyncio.create_task(dropping._write())
+        while not dropping.outbox.empty():
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        task.cancel()
+
+    asyncio.run(drain())
+    assert dropping.websocket.sent == ["one", "two"] and confirmed == ["one", "two"]
+
+
+def test_chat_socket_answers_malformed_frames_and_stays_open(monkeypatch):
+    seller, seller_email = register_test_user()
+    buyer, buyer_email = register_test_user()
+    create_test_advertisement(login_test_user(seller_email), "malformed chat ad")
+    seller_id, buyer_id = seller.json()["id"], buyer.json()["id"]
+    ad_id = latest_advertisement_id(seller_id)
+
+    with anyio.from_thread.start_blocking_portal() as portal:
+        monkeypatch.setattr(client, "portal", portal)
+        with client.websocket_connect(f"/chat/{buyer_id}?token={login_test_user(buyer_email)}") as socket:
+            for frame in ('"str"', "[1, 2]", "42", "null", "not json", '{"type": "pong"}'):
+                socket.send_text(frame)
+                assert socket.receive_text().startswith("Error")
+            socket.send_json({"receiver_id": buyer_id, "advertisement_id": ad_id, "message": "me"})
+            assert socket.receive_text() == "Error: You cannot send messages to yourself."
+
+
+def test_chat_connections_per_user_are_limited(monkeypatch):
+    from router import chat
+    from starlette.websockets import WebSocketDisconnect
+    monkeypatch.setattr(chat, "CHAT_MAX_CONNECTIONS_PER_USER", 1)
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    url = f"/chat/{user_id}?token={login_test_user(email)}"
+
+    with anyio.from_thread.start_blocking_portal() as portal:
+        monkeypatch.setattr(client, "portal", portal)
+        with client.websocket_connect(url):
+            # accepted, then closed with the code, rather than refused with HTTP 403
+            with client.websocket_connect(url) as refused_socket:
+                with pytest.raises(WebSocketDisconnect) as refused:
+                    refused_socket.receive_text()
+            assert refused.value.code == 1013
+        # the slot is free again once the first socket is gone
+        with client.websocket_connect(url):
+            pass
+
+
+def test_login_rehashes_passwords_made_with_another_bcrypt_cost():
+    from utils import security
+    email = f"{uuid.uuid4()}@example.com"
+    db = SessionLocal()
+    try:
+        db.add(DbUser(email=email, username="old hash", hashed_password=bcrypt.hashpw(b"Password123", bcrypt.gensalt(4)).decode()))
+        db.commit()
+    finally:
+        db.close()
+
+    assert login_test_user(email)
+    db = SessionLocal()
+    try:
+        new_hash = db.query(DbUser.hashed_password).filter(DbUser.email == email).scalar()
+    finally:
+        db.close()
+    assert new_hash.startswith(f"$2b${security.BCRYPT_ROUNDS:02d}$")
+    assert security.pwd_context.verify("Password123", new_hash)
+
+
+def test_password_hashing_sheds_load_when_its_queue_is_full(monkeypatch):
+    from utils import security
+    monkeypatch.setattr(security, "PASSWORD_HASH_MAX_PENDING", 0)
+    response = client.post("/auth/register", json={"email": f"{uuid.uuid4()}@example.com", "username": "busy", "password": "Password123"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert security.password_hash_stats()["rejected"] >= 1
+
+    response = client.get("/health")
+    assert response.status_code == 200
+    stats = response.json()["password_hashing"]
+    assert stats["rejected"] >= 1 and stats["workers"] == security.PASSWORD_HASH_WORKERS
+
+
+def test_cancelled_sign_ins_hold_their_hashing_slot_until_the_job_ends():
+    import threading
+    from utils import security
+    release = threading.Event()
+    pending = lambda: security.password_hash_stats()["pending"]
+
+    async def cancel_while_running():
+        before = pending()
+        task = asyncio.create_task(security._run_in_hash_pool(release.wait, 5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return before
+
+    before = asyncio.run(cancel_while_running())
+    assert pending() == before + 1  # bcrypt is still running for the cancelled request
+    release.set()
+    wait_until(lambda: pending() == before)
+
+
+def test_authenticated_requests_reuse_the_cached_user_until_it_changes():
+    from router import auth
+    from utils.security import create_access_token
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {login_test_user(email)}"}
+    assert client.get("/auth/me", headers=headers).json()["id"] == user_id
+    assert count_statements(lambda: client.get("/auth/me", headers=headers)) == 0
+
+    # tokens issued before the subject was the user id still resolve, by email
+    legacy = {"Authorization": f"Bearer {create_access_token(data={'sub': email})}"}
+    assert client.get("/auth/me", headers=legacy).json()["id"] == user_id
+
+    new_email = f"{uuid.uuid4()}@example.com"
+    db = SessionLocal()
+    try:
+        db.query(DbUser).filter(DbUser.id == user_id).one().email = new_email
+        db.commit()
+    finally:
+        db.close()
+    assert auth._principals.get(str(user_id)) is None and auth._principals.get(email) is None
+    assert client.get("/auth/me", headers=headers).json()["email"] == new_email
+    assert client.get("/auth/me", headers=legacy).status_code == 401
+
+
+def test_logout_revokes_the_token_everywhere_until_it_expires():
+    response, email = register_test_user()
+    headers = {"Authorization": f"Bearer {login_test_user(email)}"}
+    assert client.get("/auth/me", headers=headers).status_code == 200
+    assert client.post("/auth/logout", headers=headers).status_code == 200
+    assert client.get("/auth/me", headers=headers).json()["detail"] == "Token has been revoked"
+    category_id = create_test_category()
+    response = client.post("/advertisements/create", headers=headers, json={
+        "title": "after logout", "content": "c", "price": 1, "status": "OPEN",
+        "created_at": "2025-06-02T16:26:10", "category_id": category_id})
+    assert response.status_code == 401
+    # other sessions of the same user are unaffected
+    assert client.get("/auth/me", headers={"Authorization": f"Bearer {login_test_user(email)}"}).status_code == 200
+
+
+def test_revocation_stores_forget_tokens_once_they_expire():
+    from utils.revocation import InMemoryRevocationStore, RedisRevocationStore, RevocationStoreFull
+
+    async def scenario(store):
+        now = time.time()
+        await store.revoke("expired", now - 1)
+        await store.revoke("live", now + 60)
+        assert not await store.is_revoked("expired")
+        assert await store.is_revoked("live")
+        assert not await store.is_revoked("other")
+
+    store = InMemoryRevocationStore(max_entries=2)
+    asyncio.run(scenario(store))
+    now = time.time()
+    asyncio.run(store.revoke("soon", now + 0.2))
+    # full: a live revocation is never forgotten to make room, the new one is refused
+    with pytest.raises(RevocationStoreFull):
+        asyncio.run(store.revoke("later", now + 120))
+    assert asyncio.run(store.is_revoked("soon")) and asyncio.run(store.is_revoked("live"))
+    asyncio.run(store.revoke("live", now + 90))  # revoking again needs no room
+    time.sleep(0.3)
+    asyncio.run(store.revoke("later", now + 120))  # room again once "soon" has expired
+    assert len(store) == 2 and asyncio.run(store.is_revoked("later"))
+
+    fakeredis = pytest.importorskip("fakeredis")
+    asyncio.run(scenario(RedisRevocationStore(client=fakeredis.FakeAsyncRedis())))
+
+
+def test_category_summary_counts_follow_advertisement_writes():
+    from db.db_category import rebuild_category_counts
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    first, second = create_test_category(f"first {uuid.uuid4()}"), create_test_category(f"second {uuid.uuid4()}")
+
+    def counts():
+        summary = {row["id"]: row for row in client.get("/categories/summary").json()}
+        return [(summary[c]["advertisement_count"], summary[c]["open_advertisement_count"]) for c in (first, second)]
+
+    assert counts() == [(0, 0), (0, 0)]
+    assert count_statements(lambda: client.get("/categories/summary")) == 0
+    create_test_advertisement(token, "one", category_id=first)
+    create_test_advertisement(token, "two", category_id=first)
+    two = latest_advertisement_id(user_id)
+    assert counts() == [(2, 2), (0, 0)]
+    client.patch(f"/advertisements/{two}/edit", json={"category_id": second}, headers=headers)
+    assert counts() == [(1, 1), (1, 1)]
+    client.patch(f"/advertisements/{two}/status", json={"status": "RESERVED"}, headers=headers)
+    assert counts() == [(1, 1), (1, 0)]
+    client.delete(f"/advertisements/{two}", headers=headers)
+    assert counts() == [(1, 1), (0, 0)]
+
+    db = SessionLocal()
+    try:
+        db.query(DbCategory).filter(DbCategory.id == first).update({"advertisement_count": 0, "open_advertisement_count": 0})
+        db.commit()
+        rebuild_category_counts(db)
+    finally:
+        db.close()
+    assert counts() == [(1, 1), (0, 0)]
+
+
+def test_anonymous_reads_are_cached_until_a_write_touches_their_tables():
+    from utils import response_cache
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {login_test_user(email)}"}
+    create_test_advertisement(headers["Authorization"][7:], "cached ad")
+    ad_id = latest_advertisement_id(user_id)
+
+    assert client.get(f"/advertisements/{ad_id}").headers["x-cache"] == "miss"
+    assert count_statements(lambda: client.get(f"/advertisements/{ad_id}")) == 0
+    assert client.get(f"/advertisements/{ad_id}").headers["x-cache"] == "hit"
+    assert client.get("/advertisements/all", params={"limit": 2, "cursor": ""}).headers["x-cache"] == "miss"
+    assert client.get("/advertisements/all", params={"limit": 2}).headers["x-cache"] == "hit"
+    assert "x-cache" not in client.get(f"/advertisements/{ad_id}", headers=headers).headers
+
+    client.patch(f"/advertisements/{ad_id}/edit", json={"title": "edited ad"}, headers=headers)
+    response = client.get(f"/advertisements/{ad_id}")
+    assert response.headers["x-cache"] == "miss" and response.json()["title"] == "edited ad"
+
+    fakeredis = pytest.importorskip("fakeredis")
+    backend = response_cache.RedisResponseCache(client=fakeredis.FakeRedis())
+    assert backend.versions(["advertisement", "image"]) == (0, 0)
+    backend.bump(["image"])
+    assert backend.versions(["advertisement", "image"]) == (0, 1)
+    backend.set("key", b"application/json\n{}", 30)
+    assert backend.get("key") == b"application/json\n{}"
+
+
+def test_redis_response_cache_is_bumped_off_the_event_loop(monkeypatch):
+    import threading
+    from utils import response_cache
+    fakeredis = pytest.importorskip("fakeredis")
+    backend = response_cache.RedisResponseCache(client=fakeredis.FakeRedis())
+    bumped_on = []
+    bump = backend.bump
+    monkeypatch.setattr(backend, "bump", lambda tables: bumped_on.append(threading.current_thread()) or bump(tables))
+    monkeypatch.setattr(response_cache, "_backend", backend)
+    response, email = register_test_user()
+    headers = {"Authorization": f"Bearer {login_test_user(email)}"}
+    create_test_advertisement(headers["Authorization"][7:], "redis cached ad")
+    ad_id = latest_advertisement_id(response.json()["id"])
+
+    with anyio.from_thread.start_blocking_portal() as portal:
+        monkeypatch.setattr(client, "portal", portal)
+        loop_thread = portal.call(threading.current_thread)
+        assert client.get(f"/advertisements/{ad_id}").headers["x-cache"] == "miss"
+        assert client.get(f"/advertisements/{ad_id}").headers["x-cache"] == "hit"
+        bumped_on.clear()
+        client.patch(f"/advertisements/{ad_id}/edit", json={"title": "edited redis ad"}, headers=headers)
+        response = client.get(f"/advertisements/{ad_id}")
+    assert response.headers["x-cache"] == "miss" and response.json()["title"] == "edited redis ad"
+    assert bumped_on and loop_thread not in bumped_on
+
+
+def test_fast_json_listings_match_the_validated_responses(monkeypatch):
+    from utils import fast_json
+    response, email = register_test_user()
+    token = login_test_user(email)
+    for i in range(3):
+        create_test_advertisement(token, f"fast json {i}", content="fastjsoncontent")
+    requests = [("/advertisements/all", {"limit": 2}), ("/advertisements/search", {"search": "fastjsoncontent", "limit": 2})]
+
+    expected = [client.get(path, params=params, headers={"Authorization": f"Bearer {token}"}).json() for path, params in requests]
+    monkeypatch.setattr(fast_json, "FAST_JSON_LISTINGS", True)
+    actual = [client.get(path, params=params, headers={"Authorization": f"Bearer {token}"}).json() for path, params in requests]
+    assert actual == expected
+    assert len(actual[1]["items"]) == 2 and actual[1]["next_cursor"]
+    follow = client.get("/advertisements/search", params={"search": "fastjsoncontent", "cursor": actual[1]["next_cursor"]})
+    assert [item["advertisement"]["title"] for item in follow.json()["items"]] == ["fast json 0"]
+
+
+def test_export_streams_ndjson_and_filters_by_update_time(tmp_path):
+    import gzip
+    import json
+    from datetime import datetime, timedelta
+    from db.db_export import export_advertisements
+    import manage
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    token = login_test_user(email)
+    headers = {"Authorization": f"Bearer {token}"}
+    before = datetime.utcnow()
+    create_test_advertisement(token, "exported one")
+    create_test_advertisement(token, "exported two")
+    ad_id = latest_advertisement_id(user_id)
+
+    response = client.get("/advertisements/export", params={"since": before.isoformat()}, headers=headers)
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    rows = [row for row in rows if row["user_id"] == user_id]  # the overlap also covers other tests' ads
+    assert [row["title"] for row in rows] == ["exported one", "exported two"]
+    assert rows[1]["id"] == ad_id and rows[1]["status"] == "OPEN"
+
+    # the next export starts at the newest updated_at seen: rows at that timestamp come again (upserted
+    # by id), rows written meanwhile are new
+    since = datetime.fromisoformat(rows[1]["updated_at"])
+    client.patch(f"/advertisements/{ad_id - 1}/edit", json={"price": 99}, headers=headers)
+    response = client.get("/advertisements/export", params={"since": since.isoformat(), "gzip": True}, headers=headers)
+    changed = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    changed = {row["title"]: row["price"] for row in changed if row["user_id"] == user_id}
+    assert changed == {"exported two": rows[1]["price"], "exported one": 99}
+
+    # a row stamped shortly before since but committed after the last export is picked up by the overlap
+    late = datetime.fromisoformat(rows[0]["created_at"])
+    exported = [json.loads(line) for chunk in export_advertisements(late + timedelta(seconds=1), "created_at", overlap=5)
+                for line in chunk.splitlines()]
+    assert "exported one" in [row["title"] for row in exported if row["user_id"] == user_id]
+
+    assert client.get("/advertisements/export").status_code == 401
+    assert len(list(export_advertisements(before, batch_size=1, overlap=0))) == 2  # one chunk per batch
+    manage.main(["export", "--output", str(tmp_path / "ads.ndjson.gz"), "--gzip", "--since", before.isoformat()])
+    exported = [json.loads(line) for line in gzip.decompress((tmp_path / "ads.ndjson.gz").read_bytes()).splitlines()]
+    assert len([row for row in exported if row["user_id"] == user_id]) == 2
+
+
+def test_bulk_import_inserts_valid_rows_in_batches_and_reports_the_rest(tmp_path):
+    import manage
+    response, email = register_test_user()
+    user_id = response.json()["id"]
+    headers = {"Authorization": f"Bearer {login_test_user(email)}", "Content-Type": "text/csv"}
+    category_id = create_test_category(f"import {uuid.uuid4()}")
+    body = (
+        "title,content,price,status,category_id\n"
+        f"imported one,bulkimportcontent,10,OPEN,{category_id}\n"
+        f"imported two,,20,SOLD,{category_id}\n"
+        f"no price,x,,OPEN,{category_id}\n"
+        "no category,x,5,OPEN,999999\n"
+        f"imported three,bulkimportcontent,30,OPEN,{category_id}\n"
+    )
+    inserts = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO advertisement"):
+            inserts.append(executemany)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with patch("db.db_import.IMPORT_BATCH_SIZE", 3):
+            response = client.post("/advertisements/import", content=body, headers=headers)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    report = response.json()
+    assert (report["imported"], report["failed"]) == (3, 2)
+    assert [error["row"] for error in report["errors"]] == [3, 4]
+    assert "price" in report["errors"][0]["error"] and "not found" in report["errors"][1]["error"]
+    assert inserts == [True, False]  # one statement per batch
+
+    summary = {row["id"]: row for row in client.get("/categories/summary").json()}[category_id]
+    assert (summary["advertisement_count"], summary["open_advertisement_count"]) == (3, 2)
+    found = client.get("/advertisements/search", params={"search": "bulkimportcontent"}).json()["items"]
+    assert sorted(item["advertisement"]["title"] for item in found) == ["imported one", "imported three"]
+
+    # a blank content cell is stored as an empty string, which every listing can display
+    db = SessionLocal()
+    try:
+        blank_id = db.query(DbAdvertisement.id).filter(DbAdvertisement.user_id == user_id,
+                                                       DbAdvertisement.title == "imported two").scalar()
+    finally:
+        db.close()
+    response = client.get(f"/advertisements/{blank_id}")
+    assert response.status_code == 200 and response.json()["content"] == ""
+    assert client.get("/advertisements/all").status_code == 200
+    response = client.get("/advertisements/search", params={"search": "imported two"})
+    assert response.status_code == 200
+    assert "imported two" in [item["advertisement"]["title"] for item in response.json()["items"]]
+
+    # a line that is not UTF-8, or JSON that is not an object, is reported as its row; later rows still go in
+    body = (b'"str"\n' + b'{"title": "caf\xe9", "price": 1, "category_id": %d}\n' % category_id
+            + b'{"title": "after the bad line", "price": 1, "category_id": %d}\n' % category_id)
+    response = client.post("/advertisements/import", content=body,
+                           headers={**headers, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200, response.text
+    report = response.json()
+    assert report["imported"] == 1
+    assert report["errors"] == [{"row": 1, "error": "expected a JSON object"}, {"row": 2, "error": "not valid UTF-8"}]
+    body = f"title,price,category_id\nbad \xe9,1,{category_id}\n".encode("latin-1")
+    assert client.post("/advertisements/import", content=body, headers=headers).json()["errors"] == [
+        {"row": 1, "error": "not valid UTF-8"}]
+
+    ndjson = tmp_path / "ads.ndjson"
+    ndjson.write_bytes(f'{{"title": "from cli", "price": 1, "category_id": {category_id}}}\nnot json\n\xff\n'.encode("latin-1"))
+    manage.main(["import", str(ndjson), "--user-id", str(user_id)])
+    summary = {row["id"]: row for row in client.get("/categories/summary").json()}[category_id]
+    assert summary["advertisement_count"] == 5
@@ -1,39 +1,31 @@
 from fastapi import Depends, HTTPException, status, APIRouter
-from sqlalchemy.orm import Session
-from db.database import SessionLocal
-from db.model import DbAdvertisement, DbTransaction, StatusAdvertisementEnum, DbUser
-from schemas import TransactionCreate, TransactionRead
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.database import get_async_db
+from db.db_category import forget_category_summary, move_advertisement_count
+from db.model import DbAdvertisement, DbTransaction, StatusAdvertisementEnum
+from schemas import TransactionCreate, TransactionRead, UserOut
 from router.auth import read_users_me
 
 
 router = APIRouter(prefix="/purchase", tags=["Purchase"])
 
 
-# Dependency: yields a Session and closes it after use
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
 @router.post(
     "/transactions",
     response_model=TransactionRead,
     status_code=status.HTTP_201_CREATED
 )
-def purchase_advertisement(
+async def purchase_advertisement(
     data: TransactionCreate,
-    db: Session = Depends(get_db),
-    current_user: DbUser = Depends(read_users_me)  # ensures only an authorized user can call this
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserOut = Depends(read_users_me)  # ensures only an authorized user can call this
 ):
 
     # 1) The buyer is the logged‐in user
     buyer = current_user
 
     # 2) Check that advertisement exists
-    ad = db.query(DbAdvertisement).get(data.advertisement_id)
+    ad = await db.get(DbAdvertisement, data.advertisement_id)
     if not ad:
         raise HTTPException(status_code=404, detail="Advertisement not found")
 
@@ -64,11 +56,15 @@ def purchase_advertisement(
     db.add(new_tx)
 
     # 7) Mark the advertisement as SOLD so it can’t be purchased again
+    category_id, old_status = ad.category_id, ad.status
+    await db.run_sync(lambda session: move_advertisement_count(
+        session, category_id, old_status, category_id, StatusAdvertisementEnum.SOLD))
     ad.status = StatusAdvertisementEnum.SOLD
 
     # 8) Commit & refresh
-    db.commit()
-    db.refresh(new_tx)
+    await db.commit()
+    forget_category_summary()
+    await db.refresh(new_tx)
 
     return new_tx
 
@@ -77,14 +73,14 @@ def purchase_advertisement(
     response_model=TransactionRead,
     status_code=status.HTTP_200_OK
 )
-def get_transaction(
+async def get_transaction(
     transaction_id: int,
-    db: Session = Depends(get_db),
-    current_user: DbUser = Depends(read_users_me)
+    db: AsyncSession = Depends(get_async_db),
+    current_user: UserOut = Depends(read_users_me)
 ):
    
     # 1) Fetch the transaction
-    tx: DbTransaction = db.query(DbTransaction).get(transaction_id)
+    tx: DbTransaction = await db.get(DbTransaction, transaction_id)
     if not tx:
         raise HTTPException(status_code=404, detail="Transaction not found")
 
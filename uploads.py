@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+from typing import AsyncIterator, NamedTuple, Optional
+from fastapi import HTTPException, Request, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile as FormFile
+
+MAX_IMAGE_UPLOAD_BYTES = int(os.getenv("MAX_IMAGE_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+CHUNK_SIZE = 64 * 1024
+# room for the multipart boundaries and part headers around the image in a form upload
+MULTIPART_OVERHEAD = 64 * 1024
+
+# leading bytes of every allowed image format, by file extension
+MAGIC_BYTES = {
+    ".jpg": (b"\xff\xd8\xff",),
+    ".jpeg": (b"\xff\xd8\xff",),
+    ".png": (b"\x89PNG\r\n\x1a\n",),
+    ".gif": (b"GIF87a", b"GIF89a"),
+}
+MAGIC_LENGTH = max(len(magic) for signatures in MAGIC_BYTES.values() for magic in signatures)
+
+
+def _too_large():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Image is larger than {MAX_IMAGE_UPLOAD_BYTES} bytes",
+    )
+
+
+def check_content_length(content_length: Optional[str], overhead: int = 0):
+    if content_length and content_length.isdigit() and int(content_length) > MAX_IMAGE_UPLOAD_BYTES + overhead:
+        raise _too_large()
+
+
+def check_magic(head: bytes, ext: str):
+    if not head.startswith(MAGIC_BYTES[ext]):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"File content is not a {ext} image",
+        )
+
+
+# the image part of a multipart form upload. The form is parsed here rather than by a File() parameter,
+# which would spool the whole body before the route runs; the body is cut off once it is too large.
+# The caller closes the returned file.
+async def read_image_form(request: Request, field: str = "image") -> FormFile:
+    check_content_length(request.headers.get("content-length"), MULTIPART_OVERHEAD)
+    received = 0
+
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > MAX_IMAGE_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+                raise _too_large()
+        return message
+
+    form = await Request(request.scope, receive).form(max_files=1)
+    image = form.get(field)
+    if not isinstance(image, FormFile):
+        await form.close()
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Form field '{field}' must be a file")
+    return image
+
+
+async def iter_upload_file(image: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await image.read(CHUNK_SIZE):
+        yield chunk
+
+
+class ReceivedUpload(NamedTuple):
+    temp_path: str
+    size: int
+    sha256: str
+
+
+# stream chunks into a temp file in the upload directory, stopping as soon as the body is too big or
+# does not start like the claimed format; the SHA-256 of the content is computed on the way through.
+# The caller moves the temp file to its content-addressed name (or drops it if that blob exists).
+async def receive_upload(chunks: AsyncIterator[bytes], directory: str, ext: str) -> ReceivedUpload:
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".part")
+    size = 0
+    head = b""
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_IMAGE_UPLOAD_BYTES:
+                    raise _too_large()
+                if len(head) < MAGIC_LENGTH:
+                    head += chunk[:MAGIC_LENGTH - len(head)]
+                    if len(head) == MAGIC_LENGTH:
+                        check_magic(head, ext)
+                digest.update(chunk)
+                # small writes, each on the threadpool, so no thread waits on the client
+                await run_in_threadpool(buffer.write, chunk)
+        if not size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Image file is empty")
+        check_magic(head, ext)
+    except BaseException:
+        discard_upload(temp_path)
+        raise
+    return ReceivedUpload(temp_path, size, digest.hexdigest())
+
+
+def discard_upload(temp_path: str):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)